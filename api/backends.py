@@ -0,0 +1,223 @@
+import os
+
+import torch
+
+# Where ONNX exports of the models are kept, to only export them once
+ONNX_MODELS_PATH = os.environ.get(
+    "ONNX_MODELS_PATH", os.path.expanduser("~/.cache/idios/onnx")
+)
+# Minimum cosine similarity between the embeddings of a backend and the ones of
+# the reference PyTorch model for the backend to be used
+BACKEND_TOLERANCE = float(os.environ.get("BACKEND_TOLERANCE", 0.98))
+
+VERIFICATION_TEXTS = [
+    "a black and white text in japanese",
+    "a portrait of a man",
+    "a map",
+    "a cute colorful cat",
+]
+
+
+class TorchBackend:
+    "Eager PyTorch inference, the reference implementation"
+
+    def __init__(self, model):
+        self.model = model
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model.to(self.device)
+
+    @torch.no_grad()
+    def get_image_features(self, pixel_values):
+        return self.model.get_image_features(
+            pixel_values=pixel_values.to(self.device)
+        )
+
+    @torch.no_grad()
+    def get_text_features(self, input_ids, attention_mask):
+        return self.model.get_text_features(
+            input_ids=input_ids.to(self.device),
+            attention_mask=attention_mask.to(self.device),
+        )
+
+
+class QuantizedBackend(TorchBackend):
+    "PyTorch inference with linear layers dynamically quantized to int8"
+
+    def __init__(self, model):
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        self.model = model
+        self.device = "cpu"  # quantized kernels are CPU only
+
+
+class _ImageFeatures(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class _TextFeatures(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(
+            input_ids=input_ids, attention_mask=attention_mask
+        )
+
+
+class OnnxBackend:
+    "ONNX Runtime inference, with weights optionally quantized to int8"
+
+    def __init__(self, model, path, quantize=False):
+        # Optional dependency, only needed by workers using this backend
+        import onnxruntime
+
+        vision_path = os.path.join(path, "vision.onnx")
+        text_path = os.path.join(path, "text.onnx")
+        if not (os.path.exists(vision_path) and os.path.exists(text_path)):
+            export_onnx(model, path, quantize)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.vision = onnxruntime.InferenceSession(
+            vision_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.text = onnxruntime.InferenceSession(
+            text_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.device = "cpu"
+
+    def get_image_features(self, pixel_values):
+        (features,) = self.vision.run(
+            None, {"pixel_values": pixel_values.cpu().numpy()}
+        )
+        return torch.from_numpy(features)
+
+    def get_text_features(self, input_ids, attention_mask):
+        (features,) = self.text.run(
+            None,
+            {
+                "input_ids": input_ids.cpu().numpy(),
+                "attention_mask": attention_mask.cpu().numpy(),
+            },
+        )
+        return torch.from_numpy(features)
+
+
+def export_onnx(model, path, quantize=False):
+    # Exported to temporary files first, so that an interrupted export is not
+    # mistaken for a complete one
+    os.makedirs(path, exist_ok=True)
+    model = model.to("cpu").eval()
+    image_size = model.config.vision_config.image_size
+    exports = [
+        (
+            _ImageFeatures(model),
+            (torch.rand(2, 3, image_size, image_size),),
+            ["pixel_values"],
+            {"pixel_values": {0: "batch"}, "features": {0: "batch"}},
+            "vision.onnx",
+        ),
+        (
+            _TextFeatures(model),
+            (
+                torch.ones(2, 8, dtype=torch.int64),
+                torch.ones(2, 8, dtype=torch.int64),
+            ),
+            ["input_ids", "attention_mask"],
+            {
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "features": {0: "batch"},
+            },
+            "text.onnx",
+        ),
+    ]
+    for module, inputs, input_names, dynamic_axes, file_name in exports:
+        tmp_path = os.path.join(path, f"tmp.{file_name}")
+        with torch.no_grad():
+            torch.onnx.export(
+                module,
+                inputs,
+                tmp_path,
+                input_names=input_names,
+                output_names=["features"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            quantized_path = os.path.join(path, f"tmp.int8.{file_name}")
+            quantize_dynamic(tmp_path, quantized_path, weight_type=QuantType.QInt8)
+            os.replace(quantized_path, tmp_path)
+        os.replace(tmp_path, os.path.join(path, file_name))
+
+
+def cosine_agreement(backend, reference, tokenizer, image_size):
+    """
+    Returns the minimum cosine similarity between the image and text features
+    computed by the backend and by the reference backend on sample inputs.
+    """
+    generator = torch.Generator().manual_seed(2023)
+    pixel_values = torch.randn(4, 3, image_size, image_size, generator=generator)
+    texts = tokenizer(VERIFICATION_TEXTS, padding=True, return_tensors="pt")
+    pairs = [
+        (
+            backend.get_image_features(pixel_values),
+            reference.get_image_features(pixel_values),
+        ),
+        (
+            backend.get_text_features(texts["input_ids"], texts["attention_mask"]),
+            reference.get_text_features(texts["input_ids"], texts["attention_mask"]),
+        ),
+    ]
+    return min(
+        torch.nn.functional.cosine_similarity(features.cpu(), expected.cpu())
+        .min()
+        .item()
+        for features, expected in pairs
+    )
+
+
+def create_backend(backend_name, model, model_path, tokenizer):
+    """
+    Creates the named inference backend for the model. The embeddings of
+    backends other than torch are checked against the PyTorch reference,
+    and a RuntimeError is raised if they do not agree within
+    BACKEND_TOLERANCE.
+    """
+    if backend_name == "torch":
+        return TorchBackend(model)
+
+    if backend_name == "quantized":
+        backend = QuantizedBackend(model)
+    elif backend_name in ("onnx", "onnx_int8"):
+        path = os.path.join(
+            ONNX_MODELS_PATH, model_path.replace("/", "--"), backend_name
+        )
+        backend = OnnxBackend(model, path, quantize=backend_name == "onnx_int8")
+    else:
+        raise ValueError(f"Unknown inference backend {backend_name}")
+
+    agreement = cosine_agreement(
+        backend,
+        TorchBackend(model),
+        tokenizer,
+        model.config.vision_config.image_size,
+    )
+    print(f"Backend {backend_name} of {model_path}: cosine agreement {agreement:.4f}")
+    if agreement < BACKEND_TOLERANCE:
+        raise RuntimeError(
+            f"Backend {backend_name} of {model_path} disagrees with PyTorch "
+            f"(cosine similarity {agreement:.4f} < {BACKEND_TOLERANCE})"
+        )
+    return backend
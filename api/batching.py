@@ -0,0 +1,77 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Maximum number of items from concurrent requests processed together, and how
+# long to wait for other requests once one arrived (seconds). A size of 1
+# disables micro-batching.
+MICRO_BATCH_SIZE = int(os.environ.get("MICRO_BATCH_SIZE", 1))
+MICRO_BATCH_WINDOW = float(os.environ.get("MICRO_BATCH_WINDOW", 0.01))
+
+
+class MicroBatcher:
+    """
+    Gathers the items submitted by concurrent threads within a time window, up
+    to a maximum batch size, and processes them with a single call of
+    process(items), which returns one result per item. Each thread gets the
+    result of its own items.
+    """
+
+    def __init__(self, process, max_batch_size=None, window=None):
+        self.process = process
+        # Defaults read on creation, so that processes can change them first
+        self.max_batch_size = max_batch_size or MICRO_BATCH_SIZE
+        self.window = MICRO_BATCH_WINDOW if window is None else window
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        if self.max_batch_size <= 1:
+            return self.process(items)
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        futures = []
+        for item in items:
+            future = Future()
+            self.queue.put((item, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(
+                        self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            results = self.process([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Isolate the item(s) responsible for the failure
+            for item, future in batch:
+                try:
+                    future.set_result(self.process([item])[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
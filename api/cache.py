@@ -0,0 +1,194 @@
+import array
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Where the worker persists the embeddings it computed
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH",
+    os.path.expanduser("~/.cache/idios/embeddings.sqlite3"),
+)
+# Upper bound of the size of the cached embeddings, in bytes. 0 disables it.
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 2**30))
+
+# Number of text query embeddings kept in memory, and for how long (seconds)
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", 4096))
+TEXT_CACHE_TTL = float(os.environ.get("TEXT_CACHE_TTL", 3600))
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of image embeddings, keyed by the model name and a hash
+    of the image bytes, so that the same image is only embedded once whatever
+    its url. Embeddings are stored as packed float32 and the least recently
+    used ones are evicted when the cache grows over max_bytes.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.size = 0
+
+    def connect(self):
+        # Lazily, so that creating the cache never touches the disk
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key BLOB PRIMARY KEY, value BLOB, last_used REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+            self.size = self.connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM embeddings"
+            ).fetchone()[0]
+        return self.connection
+
+    @staticmethod
+    def key(model_name, data, backend="torch"):
+        # Backends compute slightly different embeddings. The keys of the torch
+        # one are the same as before backends were introduced.
+        if backend != "torch":
+            model_name = f"{model_name}/{backend}"
+        digest = hashlib.blake2b(model_name.encode() + b"\0", digest_size=20)
+        digest.update(data)
+        return digest.digest()
+
+    def get(self, key):
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            try:
+                connection = self.connect()
+                row = connection.execute(
+                    "SELECT value FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+            except sqlite3.Error as e:
+                # The cache is an optimisation, it must not fail the request
+                print(f"Embedding cache error: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return array.array("f", row[0]).tolist()
+
+    def put(self, key, embedding):
+        if self.max_bytes <= 0:
+            return
+        value = array.array("f", embedding).tobytes()
+        with self.lock:
+            try:
+                connection = self.connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (key, value, time.time()),
+                )
+                self.size += len(value)
+                if self.size > self.max_bytes:
+                    self.evict()
+            except sqlite3.Error as e:
+                print(f"Embedding cache error: {e}")
+
+    def evict(self):
+        # Removes the least recently used entries down to 90% of the maximum
+        # size, to avoid evicting on every insertion once the cache is full
+        connection = self.connect()
+        # Other workers may share the file, and entries may have been replaced
+        self.size = connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM embeddings"
+        ).fetchone()[0]
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = connection.execute(
+                "SELECT key, LENGTH(value) FROM embeddings "
+                "ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            evicted = []
+            for key, size in rows:
+                if self.size <= target:
+                    break
+                evicted.append((key,))
+                self.size -= size
+            connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self.size,
+            "max_size": self.max_bytes,
+        }
+
+
+class TTLCache:
+    """
+    In-memory cache bounded in number of entries, evicting the least recently
+    used ones first, and whose entries expire ttl seconds after being set.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "max_size": self.max_entries,
+        }
+
+
+def normalize_text(text):
+    # CLIP's tokenizer ignores case and extra white spaces anyway
+    return " ".join(text.split()).lower()
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE)
+text_cache = TTLCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL)
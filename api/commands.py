@@ -1,58 +1,136 @@
 import json
+import os
+import threading
+import time
 import numpy as np
+from PIL import Image
+from pymilvus import MilvusException
 
-from embeddings import load_image_from_url, embeddings
-from milvus import collections, metrics
+from cache import TTLCache, embedding_cache, text_cache, normalize_text
+from common import MAX_MILVUS_PAGINATION, embedding_dimensions
+from embeddings import embeddings
+from milvus import (
+    check_partitions,
+    collections,
+    cursor_expr,
+    ensure_partition,
+    get_search_params,
+    has_hashed_keys,
+    index_status,
+    maintenance_lock,
+    metrics,
+    migrate_to_hashed_keys,
+    primary_key,
+    rebuild_index,
+    supports_count_query,
+    urls_expr,
+)
+from pipeline import embed_url, embed_urls
+from writer import BufferedWriter
+
+# Consistency level of each kind of read, see
+# https://milvus.io/docs/v2.2.x/consistency.md. Searches tolerate missing the
+# very last insertions, unlike the check for existing images before insertions.
+CONSISTENCY_LEVELS = {
+    "search": "Bounded",
+    "list": "Bounded",
+    "dedup": "Strong",
+    "count": "Strong",
+    **dict(
+        item.split("=", 1)
+        for item in os.environ.get("CONSISTENCY_LEVELS", "").split(",")
+        if item
+    ),
+}
+
+# Number of candidates fetched by searches per result, re-ranked by their exact
+# distance to the query. Above 1, cheaper search parameters (e.g. a lower
+# nprobe) or a quantized index keep the same quality of results.
+SEARCH_OVERSAMPLE = int(os.environ.get("SEARCH_OVERSAMPLE", 1))
 
+# Seconds during which the approximate count of images is reused, for
+# dashboards polling it
+COUNT_CACHE_TTL = float(os.environ.get("COUNT_CACHE_TTL", 10))
 
-def format_url_list(urls):
-    quoted_urls = [f'"{url}"' for url in urls]
-    return f'[{",".join(quoted_urls)}]'
+# Number of images embedded in a single forward pass when inserting from urls
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+
+# Comma separated models to load and run once before the worker consumes jobs
+WARM_UP_MODELS = os.environ.get("WARM_UP_MODELS", ",".join(embedding_dimensions))
 
 
 def insert_images(
-    model_name, urls, metadatas, image_embeddings=None, replace_existing=True, fail_on_error=True
+    model_name,
+    urls,
+    metadatas,
+    image_embeddings=None,
+    replace_existing=True,
+    fail_on_error=True,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    partition=None,
 ):
-    existing_urls = []
+    collection = collections[model_name]
+    # Urls are compared by primary key, case insensitive hosts being the same
+    # in collections with hashed keys
+    existing_keys = set()
     if not replace_existing:
-        existing_urls = [
-            search_result["url"]
-            for search_result in collections[model_name].query(
-                f"url in {format_url_list(urls)}",
-                consistency_level="Strong",  # https://milvus.io/docs/consistency.md
+        existing_keys = {
+            primary_key(collection, search_result["url"])
+            for search_result in collection.query(
+                urls_expr(collection, urls),
+                consistency_level=CONSISTENCY_LEVELS["dedup"],
+                output_fields=["url"],
             )
-        ]
+        }
+    existing_urls = list(
+        dict.fromkeys(
+            url for url in urls if primary_key(collection, url) in existing_keys
+        )
+    )
 
-    new_urls = [url for url in urls if url not in existing_urls]
+    # Urls given several times are only inserted once
+    new_urls = {}
+    for url in urls:
+        key = primary_key(collection, url)
+        if key not in existing_keys:
+            new_urls.setdefault(key, url)
+    new_urls = list(new_urls.values())
     
     # Handle individual image failures
     successful_urls = []
     failed_urls = []
     computed_embeddings = []
-    processed_metadatas = []
+    successful_metadatas = []
     
     if image_embeddings is None:
-        # Process each image individually
-        for i, url in enumerate(new_urls):
-            try:
-                embedding = embeddings[model_name].get_image_embedding(load_image_from_url(url))
-                computed_embeddings.append(embedding)
-                processed_metadatas.append(json.dumps(metadatas[urls.index(url)]))
-                successful_urls.append(url)
-            except Exception as e:
+        # Downloads, decoding and batched inference run as pipelined stages
+        for url, embedding, error in embed_urls(model_name, new_urls, batch_size):
+            if error is not None:
                 if fail_on_error:
                     # Original behavior: propagate the exception
-                    raise
+                    raise error
                 else:
                     # New behavior: collect the error and continue
-                    failed_urls.append({"url": url, "error": str(e)})
+                    failed_urls.append(
+                        {
+                            "url": url,
+                            "error": str(error),
+                            "code": getattr(error, "code", None),
+                        }
+                    )
+                continue
+            computed_embeddings.append(embedding)
+            successful_metadatas.append(metadatas[urls.index(url)])
+            successful_urls.append(url)
     else:
         # Use provided embeddings
+        skipped_keys = set(existing_keys)
         for url, embedding in zip(urls, image_embeddings):
-            if url not in existing_urls:
+            if primary_key(collection, url) not in skipped_keys:
+                skipped_keys.add(primary_key(collection, url))
                 try:
                     computed_embeddings.append(embedding)
-                    processed_metadatas.append(json.dumps(metadatas[urls.index(url)]))
+                    successful_metadatas.append(metadatas[urls.index(url)])
                     successful_urls.append(url)
                 except Exception as e:
                     if fail_on_error:
@@ -60,10 +138,27 @@ def insert_images(
                         raise
                     else:
                         # New behavior: collect the error and continue
-                        failed_urls.append({"url": url, "error": str(e)})
+                        failed_urls.append(
+                            {
+                                "url": url,
+                                "error": str(e),
+                                "code": getattr(e, "code", None),
+                            }
+                        )
 
     if len(successful_urls) > 0:
-        collections[model_name].insert([successful_urls, computed_embeddings, processed_metadatas])
+        if partition:
+            ensure_partition(collection, partition)
+        # Large insertions are split in chunks
+        writer = BufferedWriter(collection, partition, replace=replace_existing)
+        for row in zip(successful_urls, computed_embeddings, successful_metadatas):
+            writer.add(*row)
+        writer.close()
+        if writer.failed:
+            if fail_on_error:
+                raise writer.error
+            failed_urls.extend(writer.failed)
+        successful_urls = writer.inserted
 
     return {
         "added": successful_urls,
@@ -72,79 +167,303 @@ def insert_images(
     }
 
 
-def similarity_score(distance):
+def similarity_score(distance, metric="L2"):
+    if metric == "IP":
+        # The inner product of normalised vectors is their cosine similarity,
+        # from which their squared L2 distance is 2 - 2 * cosine. Scores are
+        # thus the same whatever the metric.
+        distance = 2 - 2 * distance
     # 2 is the maximum distance between normalised vectors
     return 100 * (1 - distance / 2)
 
 
-def search_by_embedding(model_name, embedding, limit=10):
-    search_results = collections[model_name].search(
-        data=[embedding],
-        anns_field="embedding",
-        param={
-            "metric_type": metrics[model_name],
-            "params": {
-                "nprobe": 64
-            },  # https://milvus.io/docs/v1.1.1/performance_faq.md
-        },
-        output_fields=["metadata"],
-        limit=limit,
-        expr=None,
-        consistency_level="Strong",  # https://milvus.io/docs/consistency.md
+def compute_distance(metric, left, right):
+    # Consistent with the distances in milvus' search
+    left = np.array(left)
+    right = np.array(right)
+    if metric == "L2":
+        # _squared_ L2
+        return np.sum(np.square(left - right), axis=-1)
+    if metric == "IP":
+        return np.dot(left, right)  # also of each row of left if it is a matrix
+    raise RuntimeError(
+        f"Distance calculation has not been implemented for the {metric} metric. "
+        "Please contact the administrator."
     )
+
+
+def search_by_embeddings(
+    model_name,
+    query_embeddings,
+    limit=10,
+    consistency_level=None,
+    partitions=None,
+    expr=None,
+    search_params=None,
+    oversample=None,
+):
+    """
+    Searches all the embeddings with a single request, one result list each.
+    The search parameters of the index can be overridden, e.g. with a lower
+    nprobe. With an oversample above 1, oversample times more candidates are
+    searched and re-ranked by their exact distance to the query.
+    """
+    metric = metrics[model_name]
+    collection = collections[model_name]
+    hashed_keys = has_hashed_keys(collection)
+    oversample = oversample or SEARCH_OVERSAMPLE
+    topk = min(limit * oversample, MAX_MILVUS_PAGINATION)
+    params = {**get_search_params(model_name), **(search_params or {})}
+    if "ef" in params:
+        # HNSW searches must consider at least as many candidates as returned
+        params["ef"] = max(params["ef"], topk)
+    if partitions:
+        check_partitions(collection, partitions)
+    try:
+        search_results = collection.search(
+            data=query_embeddings,
+            anns_field="embedding",
+            param={
+                "metric_type": metric,
+                # https://milvus.io/docs/v1.1.1/performance_faq.md
+                "params": params,
+            },
+            output_fields=["url", "metadata"] if hashed_keys else ["metadata"],
+            limit=topk,
+            expr=expr or None,
+            partition_names=partitions or None,
+            consistency_level=consistency_level or CONSISTENCY_LEVELS["search"],
+        )
+    except MilvusException as e:
+        if not (expr or search_params):
+            raise
+        # Most likely due to the expression or the parameters
+        raise ValueError(f"Invalid filter or search parameters: {e}") from e
+    results = [
+        [
+            {
+                "url": hit.entity.get("url") if hashed_keys else hit.id,
+                "metadata": json.loads(hit.entity.get("metadata")),
+                "similarity": similarity_score(hit.distance, metric),
+            }
+            for hit in hits
+        ]
+        for hits in search_results
+    ]
+    if oversample > 1:
+        results = rerank(model_name, query_embeddings, results, limit)
+    return results
+
+
+def rerank(model_name, query_embeddings, candidates, limit):
+    """
+    Sorts the candidates of each query by their exact distance to it, computed
+    from their stored embeddings, and keeps the first limit ones.
+    """
+    metric = metrics[model_name]
+    urls = list(dict.fromkeys(c["url"] for results in candidates for c in results))
+    stored = {}
+    for start in range(0, len(urls), MAX_MILVUS_PAGINATION):
+        chunk = urls[start : start + MAX_MILVUS_PAGINATION]
+        stored.update(zip(chunk, get_stored_embeddings(model_name, chunk)))
+
+    reranked = []
+    for embedding, results in zip(query_embeddings, candidates):
+        # Unless removed since the search
+        results = [result for result in results if stored[result["url"]] is not None]
+        if not results:
+            reranked.append([])
+            continue
+        distances = compute_distance(
+            metric,
+            np.array([stored[result["url"]] for result in results], np.float32),
+            np.array(embedding, np.float32),
+        )
+        order = np.argsort(-distances if metric == "IP" else distances)[:limit]
+        reranked.append(
+            [
+                {
+                    **results[i],
+                    "similarity": float(similarity_score(distances[i], metric)),
+                }
+                for i in order
+            ]
+        )
+    return reranked
+
+
+def search_by_embedding(
+    model_name,
+    embedding,
+    limit=10,
+    consistency_level=None,
+    partitions=None,
+    expr=None,
+    search_params=None,
+    oversample=None,
+):
+    return search_by_embeddings(
+        model_name,
+        [embedding],
+        limit,
+        consistency_level,
+        partitions,
+        expr,
+        search_params,
+        oversample,
+    )[0]
+
+
+def get_stored_embeddings(model_name, urls):
+    """
+    Returns the embeddings of the urls stored in the collection, or None for
+    the missing ones. Urls are matched by primary key, see primary_key.
+    """
+    collection = collections[model_name]
+    found = {
+        primary_key(collection, entity["url"]): entity["embedding"]
+        for entity in collection.query(
+            urls_expr(collection, urls),
+            output_fields=["url", "embedding"],
+            consistency_level=CONSISTENCY_LEVELS["search"],
+        )
+    }
+    return [found.get(primary_key(collection, url)) for url in urls]
+
+
+def get_url_embeddings(model_name, urls, use_stored=True):
+    """
+    Returns the embeddings of the images at the urls. The ones of the urls
+    already in the collection are read from it, which is a single query instead
+    of a download and a forward pass per image, unless use_stored is false.
+    """
+    stored = [None] * len(urls)
+    if use_stored:
+        stored = get_stored_embeddings(model_name, urls)
     return [
-        {
-            "url": hit.id,
-            "metadata": json.loads(hit.entity.get("metadata")),
-            "similarity": similarity_score(hit.distance),
-        }
-        for hit in search_results[0]
+        embed_url(model_name, url) if embedding is None else embedding
+        for url, embedding in zip(urls, stored)
     ]
 
 
-def search_by_url(model_name, url, limit=10):
-    embedding = embeddings[model_name].get_image_embedding(load_image_from_url(url))
-    return search_by_embedding(model_name, embedding, limit)
+def search_by_url(model_name, url, limit=10, use_stored=True, **options):
+    # options are the ones of search_by_embeddings
+    (embedding,) = get_url_embeddings(model_name, [url], use_stored)
+    return search_by_embedding(model_name, embedding, limit, **options)
+
+
+def get_text_embeddings(model_name, texts):
+    keys = [(model_name, normalize_text(text)) for text in texts]
+    found = {key: text_cache.get(key) for key in keys}
+    missing = [key for key, embedding in found.items() if embedding is None]
+    if missing:
+        # Cache misses are computed together in a single forward pass, along
+        # with the ones of concurrent requests
+        computed = embeddings[model_name].text_batcher.submit_many(
+            [text for _, text in missing]
+        )
+        for key, embedding in zip(missing, computed):
+            text_cache.put(key, embedding)
+            found[key] = embedding
+    return [found[key] for key in keys]
+
+
+def search_by_text(model_name, text, limit=10, **options):
+    embedding = get_text_embeddings(model_name, [text])[0]
+    return search_by_embedding(model_name, embedding, limit, **options)
+
+
+def search_batch(
+    model_name,
+    queries,
+    limit=10,
+    use_stored=True,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    **options,
+):
+    """
+    Searches the images similar to each query, an object with either a "url" or
+    a "text". The queries are embedded in batches and searched with a single
+    Milvus request, with the options of search_by_embeddings. Returns for each
+    query either its "results", or the "error" preventing to embed it.
+    """
+    keys = [
+        ("url", query["url"]) if query.get("url") else ("text", query["text"])
+        for query in queries
+    ]
+    urls = [value for kind, value in dict.fromkeys(keys) if kind == "url"]
+    texts = [value for kind, value in dict.fromkeys(keys) if kind == "text"]
 
+    stored = {}
+    if urls and use_stored:
+        stored = dict(zip(urls, get_stored_embeddings(model_name, urls)))
+    found = {("url", url): stored[url] for url in urls if stored.get(url) is not None}
+    errors = {}
+    missing = [url for url in urls if stored.get(url) is None]
+    for url, embedding, error in embed_urls(model_name, missing, batch_size):
+        if error is None:
+            found["url", url] = embedding
+        else:
+            errors["url", url] = {
+                "error": str(error),
+                "code": getattr(error, "code", None),
+            }
+    if texts:
+        text_embeddings = get_text_embeddings(model_name, texts)
+        found.update(zip([("text", text) for text in texts], text_embeddings))
 
-def search_by_text(model_name, text, limit=10):
-    embedding = embeddings[model_name].get_text_embedding(text)
-    return search_by_embedding(model_name, embedding, limit)
+    results = {}
+    if found:
+        results = dict(
+            zip(
+                found,
+                search_by_embeddings(
+                    model_name, list(found.values()), limit, **options
+                ),
+            )
+        )
+    return [
+        {"results": results[key]} if key in results else errors[key]
+        for key in keys
+    ]
 
 
-def compare(model_name, url_left, url_right):
-    # alternatively, we could first try to fetch the embeddings from milvus in
-    # case their computation is significantly more expensive than a query
-    left = embeddings[model_name].get_image_embedding(load_image_from_url(url_left))
-    right = embeddings[model_name].get_image_embedding(load_image_from_url(url_right))
+def compare(model_name, url_left, url_right, use_stored=True):
+    left, right = get_url_embeddings(model_name, [url_left, url_right], use_stored)
 
     # calc_distance() has been removed from milvus
     # it's a bit overkill anyway if we don't compare with vectors from the db
-    if metrics[model_name] == "L2":
-        # _squared_ L2, to be consistent with the distances in milvus' search
-        return similarity_score(np.sum(np.square(np.array(left) - np.array(right))))
+    metric = metrics[model_name]
+    return similarity_score(compute_distance(metric, left, right), metric)
 
-    raise RuntimeError(
-        "Distance calculation has not been implemented in the API. "
-        "Please contact the administrator."
-    )
 
-
-def list_images(model_name, cursor="", limit=None, output_fields=None):
+def list_images(
+    model_name,
+    cursor="",
+    limit=None,
+    output_fields=None,
+    consistency_level=None,
+    partitions=None,
+):
     def prepare(entry):
         if "embedding" in entry:
             entry["embedding"] = [float(x) for x in entry["embedding"]]
         if "metadata" in entry:
             entry["metadata"] = json.loads(entry["metadata"])
+        entry.pop("id", None)  # primary key of collections with hashed keys
         return entry
 
+    collection = collections[model_name]
+    if partitions:
+        check_partitions(collection, partitions)
     return [
         search_result["url"] if output_fields is None else prepare(search_result)
-        for search_result in collections[model_name].query(
-            f'url > "{cursor}"',
-            consistency_level="Strong",  # https://milvus.io/docs/consistency.md
+        for search_result in collection.query(
+            cursor_expr(collection, cursor or ""),
+            partition_names=partitions or None,
+            consistency_level=consistency_level or CONSISTENCY_LEVELS["list"],
             limit=limit,
-            output_fields=output_fields,
+            output_fields=output_fields or ["url"],
         )
     ]
 
@@ -153,31 +472,170 @@ def ping():
     return "pong"
 
 
-def count(model_name):
-    urls = list_images(model_name)
+def warm_up(model_names, load_models=True):
+    # Runs dummy forward passes and loads the collections, so that the first
+    # requests do not pay for the lazy initialisations. Without load_models,
+    # only the collections are loaded, for processes that embed no images.
+    for model_name in model_names:
+        start = loaded = inferred = time.perf_counter()
+        if load_models:
+            model = embeddings[model_name]
+            loaded = time.perf_counter()
+            model.get_image_embeddings([Image.new("RGB", (224, 224))])
+            model.get_text_embeddings(["warm up"])
+            inferred = time.perf_counter()
+        metrics[model_name]  # loads the collection as well
+        end = time.perf_counter()
+        print(
+            f"Warmed up {model_name} in {end - start:.2f}s "
+            f"(model: {loaded - start:.2f}s, "
+            f"forward passes: {inferred - loaded:.2f}s, "
+            f"collection: {end - inferred:.2f}s)"
+        )
+
+
+def cache_stats():
+    return {"images": embedding_cache.stats(), "texts": text_cache.stats()}
+
+
+def count(model_name, exact=False, consistency_level=None, partitions=None):
+    """
+    By default, returns the number of entities from the statistics of the
+    collection, or of the given partitions, which only include flushed
+    segments and entities deleted but not yet compacted. The exact count takes
+    pending insertions and deletions into account.
+    """
+    collection = collections[model_name]
+    if partitions:
+        check_partitions(collection, partitions)
+    if exact:
+        return count_exactly(
+            model_name, consistency_level or CONSISTENCY_LEVELS["count"], partitions
+        )
+    key = (model_name, tuple(sorted(partitions or [])))
+    result = count_cache.get(key)
+    if result is None:
+        if partitions:
+            result = sum(collection.partition(name).num_entities for name in partitions)
+        else:
+            result = collection.num_entities
+        count_cache.put(key, result)
+    return result
+
+
+def count_exactly(model_name, consistency_level, partitions=None):
+    if supports_count_query():
+        return collections[model_name].query(
+            "",
+            output_fields=["count(*)"],
+            partition_names=partitions or None,
+            consistency_level=consistency_level,
+        )[0]["count(*)"]
+    print(f"count(*) requires Milvus 2.2.9, listing the images of {model_name}")
+    urls = list_images(
+        model_name, consistency_level=consistency_level, partitions=partitions
+    )
     result = len(urls)
     while urls:
-        urls = list_images(model_name, urls[-1])
+        urls = list_images(
+            model_name,
+            urls[-1],
+            consistency_level=consistency_level,
+            partitions=partitions,
+        )
         result += len(urls)
     return result
 
 
+def list_partitions(model_name):
+    return [
+        {"name": partition.name, "count": partition.num_entities}
+        for partition in collections[model_name].partitions
+    ]
+
+
+def deduplicate(model_name, batch_size=1000):
+    """
+    Collapses the rows sharing a url, inserted before insertions replaced
+    existing rows, in the background. Since queries may hide duplicates, all
+    the rows of the collection are rewritten: each batch of urls has its
+    rows deleted and a single one inserted again, in the same partition.
+    """
+    if not maintenance_lock.acquire(blocking=False):
+        raise ValueError("This worker is already rebuilding or migrating a collection")
+    collection = collections[model_name]
+
+    def rewrite():
+        try:
+            start = time.perf_counter()
+            rows_before = collection.num_entities
+            rewritten = 0
+            for partition in collection.partitions:
+                writer = BufferedWriter(
+                    collection, partition.name, replace=True, max_rows=batch_size
+                )
+                cursor = ""
+                while True:
+                    entities = list_images(
+                        model_name,
+                        cursor,
+                        batch_size,
+                        ["url", "embedding", "metadata"],
+                        "Strong",
+                        [partition.name],
+                    )
+                    if not entities:
+                        break
+                    for entity in entities:
+                        writer.add(
+                            entity["url"], entity["embedding"], entity["metadata"]
+                        )
+                    cursor = entities[-1]["url"]
+                    rewritten += len(entities)
+                writer.close()
+                if writer.failed:
+                    print(f"Failed to rewrite {len(writer.failed)} urls")
+            collection.flush()
+            # Purges the deleted rows
+            collection.compact()
+            print(
+                f"Deduplicated {model_name} in {time.perf_counter() - start:.2f}s, "
+                f"{rewritten} urls in {rows_before} rows"
+            )
+        except Exception as e:
+            print(f"Failed to deduplicate {model_name}: {e}")
+        finally:
+            maintenance_lock.release()
+
+    threading.Thread(target=rewrite, daemon=True).start()
+    return {"collection": model_name}
+
+
 def remove_images(model_name, urls):
     # Milvus only supports deleting entities with clearly specified primary
     # keys, which can be achieved merely with the term expression in. Other
     # operators can be used only in query or scalar filtering in vector search.
     # See Boolean Expression Rules for more information.
     # https://milvus.io/docs/v2.2.x/delete_data.md?shell#Delete-Entities
-    collections[model_name].delete(f"url in {format_url_list(urls)}")
+    collections[model_name].delete(urls_expr(collections[model_name], urls))
+
 
+count_cache = TTLCache(256, COUNT_CACHE_TTL)
 
 commands = dict(
     insert_images=insert_images,
     search_by_url=search_by_url,
     search_by_text=search_by_text,
+    search_batch=search_batch,
     compare=compare,
     list_images=list_images,
     count=count,
     remove_images=remove_images,
     ping=ping,
+    cache_stats=cache_stats,
+    rebuild_index=rebuild_index,
+    index_status=index_status,
+    list_partitions=list_partitions,
+    migrate_to_hashed_keys=migrate_to_hashed_keys,
+    deduplicate=deduplicate,
 )
@@ -8,4 +8,34 @@ MAX_METADATA_LENGTH = 65535
 # As of 2.3, the maximum number of items returned by pymilvus is:
 MAX_MILVUS_PAGINATION = 16384
 
+# Maximum number of queries of a batch search, so that the images of urls that
+# are not indexed can be embedded before the RPC times out
+MAX_BATCH_QUERIES = 1000
+
 JOB_QUEUE_NAME = "idios_rpc_queue"
+
+
+# Errors due to the image at a url. They are raised by the worker and re-raised
+# by the RPC client, so that the API can report them with distinct codes.
+class ImageError(ValueError):
+    code = "IMAGE_ERROR"
+
+
+class ImageSizeTooSmallError(ImageError):
+    code = "IMAGE_SIZE_TOO_SMALL"
+
+
+class ImageTooLargeError(ImageError):
+    code = "IMAGE_TOO_LARGE"
+
+
+class ImageUnsupportedTypeError(ImageError):
+    code = "IMAGE_UNSUPPORTED_TYPE"
+
+
+class ImageDownloadError(ImageError):
+    code = "IMAGE_DOWNLOAD_ERROR"
+
+
+class ImageDownloadTimeoutError(ImageDownloadError):
+    code = "IMAGE_DOWNLOAD_TIMEOUT"
@@ -1,19 +1,39 @@
-import requests
-from PIL import Image
+import functools
+import io
+import os
+import numpy as np
+from PIL import Image, UnidentifiedImageError
 
 import torch
 
 from transformers import CLIPModel, CLIPProcessor
 
+from backends import create_backend
+from batching import MicroBatcher
+from common import ImageTooLargeError, ImageUnsupportedTypeError
+from fetch import check_image_size, download_image
+from registry import Registry
 
-def load_image_from_url(url):
-    MIN_SIZE = 150
+
+def open_image(data, min_side=None):
     # not necessarily useful, as feature preprocessing might take care of it
     MAX_SIZE = 1000
 
-    with Image.open(requests.get(url, stream=True).raw) as image:
-        if min(image.size) < MIN_SIZE:
-            raise ValueError("Images must have their dimensions above 150 x 150 pixels")
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except UnidentifiedImageError as e:
+        raise ImageUnsupportedTypeError("Unsupported image format") from e
+
+    with image:
+        # Only the header has been read so far
+        check_image_size(image.size)
+
+        if min_side:
+            # JPEG images are decoded with DCT scaling straight to the smallest
+            # size whose dimensions are at least min_side (noop otherwise)
+            image.draft("RGB", (min_side, min_side))
 
         if max(image.size) > MAX_SIZE:
             image.thumbnail((MAX_SIZE, MAX_SIZE))  # noop if <= MAX_SIZE
@@ -22,37 +42,113 @@ def load_image_from_url(url):
         return image.copy()  # ensure the image data is not released
 
 
+def load_image_from_url(url):
+    return open_image(download_image(url))
+
+
 # Based on https://github.com/kingyiusuen/clip-image-search/blob/80e36511dbe1969d3989989b220c27f08d30a530/clip_image_search/clip_feature_extractor.py
 class CLIP:
-    def __init__(self, model_name):
-        self.model = CLIPModel.from_pretrained(model_name)
+    def __init__(self, model_name, backend="torch"):
         self.processor = CLIPProcessor.from_pretrained(model_name)
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model.to(self.device)
+        self.backend = create_backend(
+            backend,
+            CLIPModel.from_pretrained(model_name),
+            model_name,
+            self.processor.tokenizer,
+        )
+        # Embed the queries of concurrent requests together
+        self.image_batcher = MicroBatcher(
+            lambda pixel_values: self.get_image_embeddings_from_pixels(
+                torch.cat(pixel_values)
+            )
+        )
+        self.text_batcher = MicroBatcher(self.get_text_embeddings)
+
+    def get_text_embeddings(self, texts):
+        # One forward pass for all the texts, one embedding per text
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True)
+        text_embeddings = self.backend.get_text_features(
+            inputs["input_ids"], inputs["attention_mask"]
+        )
+        text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
+        return text_embeddings.tolist()
 
-    @torch.no_grad()
     def get_text_embedding(self, text):
-        inputs = self.processor(text=text, return_tensors="pt")
-        inputs = inputs.to(self.device)
-        text_embedding = self.model.get_text_features(**inputs)
-        text_embedding /= text_embedding.norm(dim=-1, keepdim=True)
-        text_embedding = text_embedding.tolist()
-        return text_embedding[0]
-
-    @torch.no_grad()
-    def get_image_embedding(self, images):
-        # Ensure image is a list since processor expects a batch    
-        if not isinstance(images, list):         
-            images= [images] 
-        inputs = self.processor(images=images, return_tensors="pt", padding=True)
-        inputs = inputs.to(self.device)
-        image_embedding = self.model.get_image_features(**inputs)
-        image_embedding /= image_embedding.norm(dim=-1, keepdim=True)
-        image_embedding = image_embedding.tolist()
-        return image_embedding[0]
-
-
-embeddings = {
-    "vit_b32": CLIP("openai/clip-vit-base-patch32"),
-    # "vit_l14": CLIP("openai/clip-vit-large-patch14"),
+        return self.get_text_embeddings([text])[0]
+
+    @property
+    def input_size(self):
+        return self.processor.image_processor.crop_size["height"]
+
+    def preprocess(self, images):
+        """
+        Returns the normalised pixel values of the images, as CLIPProcessor
+        does, but only resizing and cropping the images one by one. Rescaling
+        and normalising are vectorised over the whole batch.
+
+        Kept apart from the forward pass so that it can run in another thread.
+        """
+        image_processor = self.processor.image_processor
+        size = image_processor.size["shortest_edge"]
+        crop = self.input_size
+        arrays = []
+        for image in images:
+            image = image.convert("RGB")
+            # Same output size and filter as CLIPImageProcessor.resize
+            width, height = image.size
+            short, long = min(width, height), max(width, height)
+            long = int(size * long / short)
+            image = image.resize(
+                (size, long) if width <= height else (long, size),
+                Image.Resampling.BICUBIC,
+            )
+            left = (image.width - crop) // 2
+            top = (image.height - crop) // 2
+            arrays.append(np.asarray(image.crop((left, top, left + crop, top + crop))))
+
+        # Same operations and precision as CLIPImageProcessor
+        pixel_values = (np.stack(arrays) * (1 / 255)).astype(np.float32)
+        pixel_values -= np.array(image_processor.image_mean, dtype=np.float32)
+        pixel_values /= np.array(image_processor.image_std, dtype=np.float32)
+        return torch.from_numpy(pixel_values.transpose(0, 3, 1, 2).copy())
+
+    def get_image_embeddings_from_pixels(self, pixel_values):
+        image_embeddings = self.backend.get_image_features(pixel_values)
+        image_embeddings /= image_embeddings.norm(dim=-1, keepdim=True)
+        return image_embeddings.tolist()
+
+    def get_image_embeddings(self, images):
+        # One forward pass for the whole batch, one embedding per image
+        return self.get_image_embeddings_from_pixels(self.preprocess(images))
+
+    def get_image_embedding(self, image):
+        return self.get_image_embeddings([image])[0]
+
+
+models = {
+    "vit_b32": "openai/clip-vit-base-patch32",
+    # "vit_l14": "openai/clip-vit-large-patch14",
 }
+
+# Inference backend of each model, e.g. "vit_b32=onnx,vit_l14=quantized".
+# One of torch (default), quantized, onnx or onnx_int8.
+backends = dict(
+    item.split("=", 1)
+    for item in os.environ.get("EMBEDDING_BACKENDS", "").split(",")
+    if item
+)
+
+# Models are loaded on first use
+embeddings = Registry(
+    {
+        name: functools.partial(CLIP, path, backends.get(name, "torch"))
+        for name, path in models.items()
+    },
+    "embedding model",
+)
+
+
+if __name__ == "__main__":
+    # Download the models, e.g. when building the worker docker image
+    for name in models:
+        embeddings[name]
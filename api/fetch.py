@@ -0,0 +1,253 @@
+import io
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from common import (
+    ImageDownloadError,
+    ImageError,
+    ImageDownloadTimeoutError,
+    ImageSizeTooSmallError,
+    ImageTooLargeError,
+    ImageUnsupportedTypeError,
+)
+
+MIN_IMAGE_SIZE = 150
+# Larger images are rejected before being decoded (decompression bombs)
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Larger files are rejected without being downloaded entirely
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 50 * 2**20))
+# Seconds to wait for the connection to an image server, and between two reads
+FETCH_TIMEOUT = (
+    float(os.environ.get("FETCH_CONNECT_TIMEOUT", 5)),
+    float(os.environ.get("FETCH_READ_TIMEOUT", 30)),
+)
+# Maximum number of concurrent downloads from a single host, and of requests
+# per second to a single host (0 for no limit)
+FETCH_HOST_CONCURRENCY = int(os.environ.get("FETCH_HOST_CONCURRENCY", 8))
+FETCH_HOST_RATE = float(os.environ.get("FETCH_HOST_RATE", 0))
+# Number of retries of requests throttled by the server, waiting
+# FETCH_BACKOFF * 2 ** attempt seconds or as long as the server asks
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 3))
+FETCH_BACKOFF = float(os.environ.get("FETCH_BACKOFF", 1))
+# Size of the images requested from IIIF image servers instead of the full
+# size ones, 0 to always download the original images
+IIIF_SIZE = int(os.environ.get("IIIF_SIZE", 448))
+
+RETRY_STATUSES = (429, 503)
+MAX_RETRY_DELAY = 60
+# Number of hosts whose connections are kept alive
+MAX_POOLED_HOSTS = 32
+CHUNK_SIZE = 64 * 1024
+# Headers are looked for in the beginning of the file only (they may be
+# preceded by EXIF data including a thumbnail)
+MAX_HEADER_BYTES = 2**20
+# Some servers do not know better than this for images
+ACCEPTED_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+
+class HostLimiter:
+    """
+    Context manager limiting the number of concurrent requests to a host, and
+    spacing them to send at most rate requests per second.
+    """
+
+    def __init__(self, concurrency, rate=0):
+        self.semaphore = threading.BoundedSemaphore(max(concurrency, 1))
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_request = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        if self.interval:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.next_request - now
+                self.next_request = max(now, self.next_request) + self.interval
+            if delay > 0:
+                time.sleep(delay)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class FetchClient:
+    """
+    HTTP client shared by the threads of the worker. It keeps connections
+    alive in a pool per host, limits the concurrency and rate of the requests
+    to each host, and retries the requests throttled by servers.
+    """
+
+    def __init__(
+        self,
+        host_concurrency=FETCH_HOST_CONCURRENCY,
+        host_rate=FETCH_HOST_RATE,
+        retries=FETCH_RETRIES,
+        backoff=FETCH_BACKOFF,
+    ):
+        self.host_concurrency = host_concurrency
+        self.host_rate = host_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=MAX_POOLED_HOSTS,
+            pool_maxsize=max(host_concurrency, 1),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(
+                    self.host_concurrency, self.host_rate
+                )
+            return self.limiters[host]
+
+    def retry_delay(self, response, attempt):
+        delay = self.backoff * 2**attempt
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return min(delay, MAX_RETRY_DELAY)
+
+    @contextmanager
+    def get(self, url):
+        """
+        Streams the response to a GET request of url. The request counts
+        towards the limits of its host until the context is exited.
+        """
+        limiter = self.limiter(urlsplit(url).netloc)
+        for attempt in range(self.retries + 1):
+            with limiter:
+                with self.session.get(
+                    url, stream=True, timeout=FETCH_TIMEOUT
+                ) as response:
+                    if (
+                        response.status_code not in RETRY_STATUSES
+                        or attempt == self.retries
+                    ):
+                        yield response
+                        return
+                    delay = self.retry_delay(response, attempt)
+            time.sleep(delay)
+
+
+fetch_client = FetchClient()
+
+
+def check_image_size(size):
+    if min(size) < MIN_IMAGE_SIZE:
+        raise ImageSizeTooSmallError(
+            "Images must have their dimensions above 150 x 150 pixels"
+        )
+    if size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"Images must have at most {MAX_IMAGE_PIXELS} pixels")
+
+
+def read_image_size(data):
+    # Returns None until data includes the whole header of the image
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except Exception:
+        return None
+
+
+def check_content_type(content_type):
+    content_type = content_type.split(";")[0].strip().lower()
+    if (
+        content_type
+        and not content_type.startswith("image/")
+        and content_type not in ACCEPTED_CONTENT_TYPES
+    ):
+        raise ImageUnsupportedTypeError(f"Unsupported content type {content_type}")
+
+
+# {identifier}/{region}/{size}/{rotation}/{quality}.{format} of the IIIF Image
+# API, only when the full size is requested
+IIIF_URL = re.compile(
+    r"^(?P<prefix>.+/[^/]+/[^/]+)/(?:full|max)"
+    r"(?P<suffix>/!?[0-9.]+/(?:default|color|colour|gray|grey|bitonal|native)"
+    r"\.[a-z0-9]+)$"
+)
+
+
+def iiif_derivative_url(url, size=IIIF_SIZE):
+    """
+    Returns the url of the image at most size x size pixels large scaled by
+    the IIIF image server, or None if url is not a full size IIIF image.
+    """
+    match = IIIF_URL.match(url)
+    if size <= 0 or match is None:
+        return None
+    return f"{match['prefix']}/!{size},{size}{match['suffix']}"
+
+
+def download_image(url):
+    """
+    Returns the content of the image at url. For IIIF images, the server is
+    asked for a scaled down version, unless it fails or the result would be
+    smaller than what the models need (typically for panoramic images).
+    """
+    derivative_url = iiif_derivative_url(url)
+    if derivative_url is not None:
+        try:
+            data = download(derivative_url)
+            size = read_image_size(data)
+            if size is not None and min(size) >= IIIF_SIZE // 2:
+                return data
+        except ImageError:
+            pass
+    return download(url)
+
+
+def download(url):
+    """
+    Returns the content of the image at url. The download is aborted as soon
+    as the headers of the response or of the image show that it would be
+    rejected: the content type is not an image, the file is larger than
+    MAX_IMAGE_BYTES, or the image dimensions are out of bounds.
+    """
+    try:
+        with fetch_client.get(url) as response:
+            response.raise_for_status()
+            check_content_type(response.headers.get("Content-Type", ""))
+            if int(response.headers.get("Content-Length", 0)) > MAX_IMAGE_BYTES:
+                raise ImageTooLargeError(
+                    f"Images must be at most {MAX_IMAGE_BYTES} bytes large"
+                )
+
+            data = bytearray()
+            header_checked = False
+            for chunk in response.iter_content(CHUNK_SIZE):
+                data += chunk
+                if len(data) > MAX_IMAGE_BYTES:
+                    raise ImageTooLargeError(
+                        f"Images must be at most {MAX_IMAGE_BYTES} bytes large"
+                    )
+                if not header_checked and len(data) <= MAX_HEADER_BYTES:
+                    size = read_image_size(data)
+                    if size is not None:
+                        check_image_size(size)
+                        header_checked = True
+            return bytes(data)
+    except requests.Timeout as e:
+        raise ImageDownloadTimeoutError(f"Timeout while downloading {url}") from e
+    except requests.RequestException as e:
+        raise ImageDownloadError(f"Failed to download {url}: {e}") from e
@@ -1,12 +1,18 @@
 from fastapi import FastAPI, status, HTTPException, Query
-from pydantic import BaseModel, HttpUrl, confloat, conint
+from pydantic import BaseModel, Field, HttpUrl, confloat, conint, conlist, constr
 from enum import Enum
 from typing import Literal, Optional
 
 import json
 
-from common import embedding_dimensions, MAX_METADATA_LENGTH, MAX_MILVUS_PAGINATION
-from rpc_client import RpcClient
+from common import (
+    embedding_dimensions,
+    ImageError,
+    MAX_BATCH_QUERIES,
+    MAX_METADATA_LENGTH,
+    MAX_MILVUS_PAGINATION,
+)
+from rpc_client import AsyncRpcClient
 
 
 app = FastAPI(
@@ -26,6 +32,10 @@ It supports several embedding models. Images can be added to each of these model
 Endpoints to manipulate the index of images for each embedding model
             """.strip(),
         },
+        {
+            "name": "admin",
+            "description": "Endpoints to maintain the Milvus collection of each model",
+        },
         {"name": "misc", "description": "Extra"},
     ],
 )
@@ -51,6 +61,8 @@ Assumptions
 - Images are accessible from the server where Idios is hosted and do not require authentication.
 - Only JPEG images are supported
 - Images must have their dimensions above 150 x 150 pixels, otherwise the API will return an error `IMAGE_SIZE_TOO_SMALL`
+- Images larger than the configured limits (file size or number of pixels) are rejected with an error `IMAGE_TOO_LARGE`, files that are not images with `IMAGE_UNSUPPORTED_TYPE`.
+- Images that cannot be downloaded are rejected with an error `IMAGE_DOWNLOAD_ERROR`, or `IMAGE_DOWNLOAD_TIMEOUT` if the image server is too slow to answer.
 - If one of the image dimension exceeds 1000 pixels, Idios will resize the image so that the maximum dimension is set to 1000 pixels and the original aspect ratio is kept.
 - Some image links may be permalinks from library or museum image collections or be hosted on IIIF servers that only accept certain request headers, additionally, the URL may return a 303 redirect to point you to the actual image. The API should be able to handle the redirect silently and still use the original URL as the primary key.
 """.strip(),
@@ -91,14 +103,111 @@ class ImageAndMetada(SingleImage):
     metadata: ImageMetadata | None
 
 
-class SearchParameters(BaseModel):
+class ConsistencyLevel(str, Enum):
+    """
+    How up to date the results of a read must be, see
+    https://milvus.io/docs/v2.2.x/consistency.md. By default, searches and
+    listings are Bounded, and exact counts are Strong.
+    """
+
+    strong = "Strong"
+    session = "Session"
+    bounded = "Bounded"
+    eventually = "Eventually"
+
+
+# https://milvus.io/docs/v2.2.x/limitations.md#Naming-rules
+PartitionName = constr(regex=r"^[A-Za-z_][A-Za-z0-9_]*$", max_length=255)
+
+PARTITION_QUERY = Query(
+    None,
+    description="""
+Partition to add the images to, created if it does not exist. Images from several sources can be kept in distinct partitions, to search only some of them.
+""".strip(),
+)
+PARTITIONS_QUERY = Query(None, description="Only consider the images of these partitions")
+
+
+def rpc_kwargs(**kwargs):
+    # Optional arguments are only sent when set
+    return {
+        key: value.value if isinstance(value, Enum) else value
+        for key, value in kwargs.items()
+        if value is not None
+    }
+
+
+class SearchOptions(BaseModel):
+    limit: conint(ge=1) = 10
+    consistency_level: Optional[ConsistencyLevel]
+    partitions: Optional[list[PartitionName]] = Field(
+        None, description="Only search the images of these partitions"
+    )
+    filter: Optional[str] = Field(
+        None,
+        description="""
+[Boolean expression](https://milvus.io/docs/v2.2.x/boolean.md) on the metadata fields declared in the METADATA_FIELDS configuration of the worker. Only matching images are searched.
+""".strip(),
+        example='language == "ja"',
+    )
+    search_params: Optional[dict] = Field(
+        None,
+        description="""
+[Search parameters](https://milvus.io/docs/v2.2.x/index.md) of the index overriding the configured ones, e.g. a lower `nprobe` for a faster search that may miss some results.
+""".strip(),
+        example={"nprobe": 16},
+    )
+    oversample: Optional[conint(ge=1, le=100)] = Field(
+        None,
+        description="""
+Search this many times more candidates than the limit, and keep the ones closest to the query by their exact distance. Combined with cheaper search parameters, results are as good for a lower cost.
+""".strip(),
+    )
+
+    def rpc_kwargs(self):
+        return rpc_kwargs(
+            consistency_level=self.consistency_level,
+            partitions=self.partitions,
+            expr=self.filter,
+            search_params=self.search_params,
+            oversample=self.oversample,
+        )
+
+
+class SearchParameters(SearchOptions):
+    text: Optional[str]
+    url: Optional[ImageUrl]
+    use_stored_embedding: bool = Field(
+        True,
+        description="""
+Reuse the embedding of the url if it is already in the index, instead of downloading and embedding the image again.
+""".strip(),
+    )
+
+
+class SearchQuery(BaseModel):
     text: Optional[str]
     url: Optional[ImageUrl]
-    limit: conint(ge=1) = 10
+
+
+class BatchSearchParameters(SearchOptions):
+    queries: conlist(SearchQuery, min_items=1, max_items=MAX_BATCH_QUERIES)
+    use_stored_embeddings: bool = Field(
+        True,
+        description="""
+Reuse the embeddings of the urls already in the index, instead of downloading and embedding the images again.
+""".strip(),
+    )
 
 
 class ImagePair(SingleImage):
     other: ImageUrl
+    use_stored_embeddings: bool = Field(
+        True,
+        description="""
+Reuse the embeddings of the urls already in the index, instead of downloading and embedding the images again.
+""".strip(),
+    )
 
 
 class SimilarityScore(BaseModel):
@@ -120,16 +229,50 @@ class SearchResults(BaseModel):
     __root__: list[SearchResult]
 
 
+class BatchSearchResult(BaseModel):
+    "Either the results of the query, or the error preventing to search them"
+
+    results: SearchResults | None
+    error: str | None
+    code: str | None
+
+
 class DatabaseEntry(ImageAndMetada):
     embedding: list[float]
 
 
-def try_rpc(command, args):
-    # Create a new client each time, i.e. reconnect and set up the channel
-    # This costs < 10ms, but fixes disconnections and parallelisation issues
-    rpc_client = RpcClient()
+class IndexConfig(BaseModel):
+    """
+    Type of the vector index and its build parameters, see
+    https://milvus.io/docs/v2.2.x/index.md. Parameters left out take default
+    values. Search parameters are the ones of the INDEX_CONFIGS configuration
+    of the workers for this type, or the default ones.
+    """
+
+    index_type: Literal["IVF_FLAT", "IVF_SQ8", "IVF_PQ", "HNSW"]
+    params: dict | None = Field(None, example={"M": 16, "efConstruction": 256})
+
+
+# Shared by all the requests of the process, which may await their responses
+# concurrently
+rpc_client = AsyncRpcClient()
+
+
+@app.on_event("shutdown")
+def close_rpc_client():
+    rpc_client.close()
+
+
+async def try_rpc(command, args, kwargs=None):
     try:
-        return rpc_client(command, args)
+        if kwargs:
+            return await rpc_client(command, args, kwargs)
+        return await rpc_client(command, args)
+    except ImageError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=[{"msg": str(e), "type": e.code}],
+        )
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -140,8 +283,6 @@ def try_rpc(command, args):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=[{"msg": str(e), "type": "server_error"}],
         )
-    finally:
-        rpc_client.connection.close()
 
 
 @app.post(
@@ -153,10 +294,15 @@ Adds a new image embedding to the index.
 Adding an existing url will replace the metadata with the provided one.
     """.strip(),
 )
-async def upsert_image(model_name: ModelName, image: ImageAndMetada):
-    try_rpc(
+async def upsert_image(
+    model_name: ModelName,
+    image: ImageAndMetada,
+    partition: PartitionName | None = PARTITION_QUERY,
+):
+    await try_rpc(
         "insert_images",
         [model_name.value, [image.url], [check_json_string_length(image.metadata)]],
+        rpc_kwargs(partition=partition),
     )
 
 
@@ -170,8 +316,12 @@ Adding an existing url will trigger a 409 HTTP error.
     """.strip(),
     responses={409: {"description": "Image already inserted"}},
 )
-async def insert_image(model_name: ModelName, image: ImageAndMetada):
-    result = try_rpc(
+async def insert_image(
+    model_name: ModelName,
+    image: ImageAndMetada,
+    partition: PartitionName | None = PARTITION_QUERY,
+):
+    result = await try_rpc(
         "insert_images",
         [
             model_name.value,
@@ -180,6 +330,7 @@ async def insert_image(model_name: ModelName, image: ImageAndMetada):
             None,
             False,
         ],
+        rpc_kwargs(partition=partition),
     )
 
     if (
@@ -217,11 +368,15 @@ Adds multiple image embeddings to the index.
 Existing urls will have their metadata replaced with the provided one.
     """.strip(),
 )
-async def restore(model_name: ModelName, images: list[DatabaseEntry]):
+async def restore(
+    model_name: ModelName,
+    images: list[DatabaseEntry],
+    partition: PartitionName | None = PARTITION_QUERY,
+):
     # The type declaration generates the openapi documentation as expected
     # but results in this rather ugly line. There may be a better use of pydantic
     # images = images.__root__
-    try_rpc(
+    await try_rpc(
         "insert_images",
         [
             model_name.value,
@@ -229,6 +384,7 @@ async def restore(model_name: ModelName, images: list[DatabaseEntry]):
             [check_json_string_length(image.metadata) for image in images],
             [image.embedding for image in images],
         ],
+        rpc_kwargs(partition=partition),
     )
 
 
@@ -249,8 +405,12 @@ Returns lists of successfully added URLs, existing URLs, and failed URLs with er
     """.strip(),
     response_model=BulkInsertResult
 )
-async def add_bulk(model_name: ModelName, images: list[ImageAndMetada]):
-    result = try_rpc(
+async def add_bulk(
+    model_name: ModelName,
+    images: list[ImageAndMetada],
+    partition: PartitionName | None = PARTITION_QUERY,
+):
+    result = await try_rpc(
         "insert_images",
         [
             model_name.value,
@@ -260,6 +420,7 @@ async def add_bulk(model_name: ModelName, images: list[ImageAndMetada]):
             True,   # Replace existing
             False,  # Don't fail on error, continue processing
         ],
+        rpc_kwargs(partition=partition),
     )
     return result
 
@@ -271,10 +432,17 @@ async def add_bulk(model_name: ModelName, images: list[ImageAndMetada]):
     response_model=SearchResults,
 )
 async def search(model_name: ModelName, params: SearchParameters):
+    kwargs = params.rpc_kwargs()
     if params.url:
-        return try_rpc("search_by_url", [model_name.value, params.url, params.limit])
+        if not params.use_stored_embedding:
+            kwargs["use_stored"] = False
+        return await try_rpc(
+            "search_by_url", [model_name.value, params.url, params.limit], kwargs
+        )
     elif params.text:
-        return try_rpc("search_by_text", [model_name.value, params.text, params.limit])
+        return await try_rpc(
+            "search_by_text", [model_name.value, params.text, params.limit], kwargs
+        )
     else:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -282,6 +450,33 @@ async def search(model_name: ModelName, params: SearchParameters):
         )
 
 
+@app.post(
+    "/models/{model_name}/search_batch",
+    tags=["model"],
+    summary="Search images similar to each of several urls or texts at once",
+    response_model=list[BatchSearchResult],
+)
+async def search_batch(model_name: ModelName, params: BatchSearchParameters):
+    for query in params.queries:
+        if not (query.url or query.text):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Either 'text' or 'url' must be provided for each query.",
+            )
+    return await try_rpc(
+        "search_batch",
+        [
+            model_name.value,
+            [query.dict(exclude_none=True) for query in params.queries],
+            params.limit,
+        ],
+        rpc_kwargs(
+            **params.rpc_kwargs(),
+            use_stored=None if params.use_stored_embeddings else False,
+        ),
+    )
+
+
 @app.post(
     "/models/{model_name}/compare",
     tags=["model"],
@@ -289,7 +484,11 @@ async def search(model_name: ModelName, params: SearchParameters):
     response_model=SimilarityScore,
 )
 async def compare(model_name: ModelName, images: ImagePair):
-    return try_rpc("compare", [model_name.value, images.url, images.other])
+    return await try_rpc(
+        "compare",
+        [model_name.value, images.url, images.other],
+        rpc_kwargs(use_stored=None if images.use_stored_embeddings else False),
+    )
 
 
 @app.post(
@@ -302,10 +501,15 @@ Use the pagination cursor to make sure that the enumeration reached the end.
     response_model=list[ImageUrl],
 )
 async def list_images(
-    model_name: ModelName, pagination: Pagination = Pagination(cursor=None, limit=None)
+    model_name: ModelName,
+    pagination: Pagination = Pagination(cursor=None, limit=None),
+    consistency_level: ConsistencyLevel | None = None,
+    partitions: list[PartitionName] | None = PARTITIONS_QUERY,
 ):
-    return try_rpc(
-        "list_images", [model_name.value, pagination.cursor, pagination.limit]
+    return await try_rpc(
+        "list_images",
+        [model_name.value, pagination.cursor, pagination.limit],
+        rpc_kwargs(consistency_level=consistency_level, partitions=partitions),
     )
 
 
@@ -319,9 +523,12 @@ Use the pagination cursor to make sure that the enumeration reached the end.
     response_model=list[DatabaseEntry],
 )
 async def dump(
-    model_name: ModelName, pagination: Pagination = Pagination(cursor=None, limit=None)
+    model_name: ModelName,
+    pagination: Pagination = Pagination(cursor=None, limit=None),
+    consistency_level: ConsistencyLevel | None = None,
+    partitions: list[PartitionName] | None = PARTITIONS_QUERY,
 ):
-    return try_rpc(
+    return await try_rpc(
         "list_images",
         [
             model_name.value,
@@ -329,6 +536,7 @@ async def dump(
             pagination.limit,
             ["url", "embedding", "metadata"],
         ],
+        rpc_kwargs(consistency_level=consistency_level, partitions=partitions),
     )
 
 
@@ -337,8 +545,37 @@ async def dump(
     tags=["model"],
     summary="Count the number of images in in a given index",
 )
-async def count(model_name: ModelName):
-    return try_rpc("count", [model_name.value])
+async def count(
+    model_name: ModelName,
+    exact: bool = Query(
+        False,
+        description="""
+By default, the count is read from the statistics of the collection, which may lag behind recent additions and removals, and cached for a few seconds. The exact count is slower.
+""".strip(),
+    ),
+    consistency_level: ConsistencyLevel | None = Query(
+        None, description="Consistency level of the exact count"
+    ),
+    partitions: list[PartitionName] | None = PARTITIONS_QUERY,
+):
+    return await try_rpc(
+        "count",
+        [model_name.value],
+        rpc_kwargs(
+            exact=True if exact else None,
+            consistency_level=consistency_level,
+            partitions=partitions,
+        ),
+    )
+
+
+@app.get(
+    "/models/{model_name}/partitions",
+    tags=["model"],
+    summary="List the partitions of the index, with their approximate image counts",
+)
+async def list_partitions(model_name: ModelName):
+    return await try_rpc("list_partitions", [model_name.value])
 
 
 @app.post(
@@ -348,7 +585,56 @@ async def count(model_name: ModelName):
     summary="Remove an image embedding from the index.",
 )
 async def remove_image(model_name: ModelName, image: SingleImage):
-    return try_rpc("remove_images", [model_name.value, [image.url]])
+    return await try_rpc("remove_images", [model_name.value, [image.url]])
+
+
+@app.post(
+    "/models/{model_name}/index",
+    tags=["admin"],
+    summary="""
+Rebuild the index of the collection with another type or other parameters.
+Searches fail until the new index is built and loaded, see the index status.
+""".strip(),
+)
+async def rebuild_index(model_name: ModelName, config: IndexConfig):
+    return await try_rpc(
+        "rebuild_index",
+        [model_name.value, config.index_type, config.params],
+    )
+
+
+@app.get(
+    "/models/{model_name}/index",
+    tags=["admin"],
+    summary="Get the index parameters and the progress of its building and loading",
+)
+async def index_status(model_name: ModelName):
+    return await try_rpc("index_status", [model_name.value])
+
+
+@app.post(
+    "/models/{model_name}/migrate_to_hashed_keys",
+    tags=["admin"],
+    summary="""
+Copy the collection to one whose primary keys are hashes of the urls, which
+then replaces it. The original collection is kept as a backup. Images added or
+removed during the migration are lost, and workers must be restarted after it.
+""".strip(),
+)
+async def migrate_to_hashed_keys(model_name: ModelName):
+    return await try_rpc("migrate_to_hashed_keys", [model_name.value])
+
+
+@app.post(
+    "/models/{model_name}/deduplicate",
+    tags=["admin"],
+    summary="""
+Collapse the rows added for the same url before additions replaced existing
+images. All the images are rewritten in the background.
+""".strip(),
+)
+async def deduplicate(model_name: ModelName):
+    return await try_rpc("deduplicate", [model_name.value])
 
 
 @app.get(
@@ -364,5 +650,5 @@ async def ping(
     )
 ):
     if rpc:
-        return try_rpc("ping", [])
+        return await try_rpc("ping", [])
     return "pong"
@@ -10,12 +10,70 @@ from pymilvus import (
     MilvusException,
 )
 
+import functools
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
 
+from cache import TTLCache
 from common import embedding_dimensions, MAX_METADATA_LENGTH
+from registry import Registry
 
 DEFAULT_ROOT_PASSWORD = "Milvus"
 
+# Build and search parameters of the supported index types
+# https://milvus.io/docs/v2.2.x/index.md
+INDEX_TYPES = {
+    "IVF_FLAT": ({"nlist": 2048}, {"nprobe": 64}),
+    "IVF_SQ8": ({"nlist": 2048}, {"nprobe": 64}),
+    "IVF_PQ": ({"nlist": 2048, "m": 64, "nbits": 8}, {"nprobe": 64}),
+    "HNSW": ({"M": 16, "efConstruction": 256}, {"ef": 128}),
+}
+# Valid ranges of the build parameters, m must also divide the dimension
+INDEX_PARAM_RANGES = {
+    "nlist": (1, 65536),
+    "m": (1, 65536),
+    "nbits": (1, 16),
+    "M": (4, 64),
+    "efConstruction": (8, 512),
+}
+# Embeddings are normalised, so the inner product (IP) is their cosine
+# similarity, and ranks them as L2 does
+METRIC_TYPES = ("L2", "IP")
+# Index of the collection of each model, as a JSON object, e.g.
+# {"vit_b32": {"index_type": "HNSW", "metric_type": "IP", "params": {"M": 32}}}
+# Unspecified parameters take the default values of the index type.
+INDEX_CONFIGS = json.loads(os.environ.get("INDEX_CONFIGS", "{}"))
+# Comma separated models whose new collections have the 64 bits hash of the
+# url as primary key rather than the url itself, see url_key
+HASHED_KEY_MODELS = [
+    name for name in os.environ.get("HASHED_KEY_MODELS", "").split(",") if name
+]
+# Metadata keys of each model copied to typed fields of new collections, so that
+# searches can be filtered on them, as a JSON object, e.g.
+# {"vit_b32": {"language": "VARCHAR", "year": {"type": "INT64", "index": true}}}
+# Types are BOOL, INT64, DOUBLE or VARCHAR (with a max_length, 256 by default),
+# and index creates a scalar index, only supported by VARCHAR fields in 2.2.
+METADATA_FIELDS = json.loads(os.environ.get("METADATA_FIELDS", "{}"))
+# Python type and value of missing metadata of each type of field
+METADATA_FIELD_TYPES = {
+    "BOOL": (DataType.BOOL, bool, False),
+    "INT64": (DataType.INT64, int, 0),
+    "DOUBLE": (DataType.DOUBLE, float, 0.0),
+    "VARCHAR": (DataType.VARCHAR, str, ""),
+}
+RESERVED_FIELDS = ("id", "url", "embedding", "metadata")
+# Number of entities copied at once by migrate_to_hashed_keys
+MIGRATION_BATCH_SIZE = 1000
+# First version of Milvus supporting count(*) queries
+COUNT_QUERY_VERSION = (2, 2, 9)
+# Workers notice the index of a collection was rebuilt after this many seconds
+INDEX_CACHE_TTL = 60
+
 
 def ensure_connection():
     if dict(connections.list_connections())["default"] is not None:
@@ -46,7 +104,14 @@ def ensure_connection():
 
 
 # https://github.com/towhee-io/examples/blob/9d199df094e3ec96a0764485ef48285b70be4193/image/reverse_image_search/1_build_image_search_engine.ipynb
-def get_collection(collection_name, dim):
+def get_collection(
+    collection_name, dim, index=None, hashed_keys=None, metadata_fields=None
+):
+    """
+    Returns the loaded collection, created with the given index and metadata
+    fields configurations (see INDEX_CONFIGS and METADATA_FIELDS) if it does
+    not exist.
+    """
     ensure_connection()
 
     if utility.has_collection(collection_name):
@@ -54,6 +119,8 @@ def get_collection(collection_name, dim):
         collection.load()
         return collection
 
+    if hashed_keys is None:
+        hashed_keys = collection_name in HASHED_KEY_MODELS
     embedding_field_name = "embedding"
     fields = [
         FieldSchema(
@@ -61,7 +128,7 @@ def get_collection(collection_name, dim):
             dtype=DataType.VARCHAR,
             description="url to image",
             max_length=2083,  # https://docs.pydantic.dev/usage/types/#urls
-            is_primary=True,
+            is_primary=not hashed_keys,
             auto_id=False,
         ),
         FieldSchema(
@@ -77,30 +144,486 @@ def get_collection(collection_name, dim):
             max_length=MAX_METADATA_LENGTH,
         ),
     ]
+    if hashed_keys:
+        fields.insert(
+            0,
+            FieldSchema(
+                name="id",
+                dtype=DataType.INT64,
+                description="hash of the url",
+                is_primary=True,
+                auto_id=False,
+            ),
+        )
+    if metadata_fields is None:
+        metadata_fields = METADATA_FIELDS.get(collection_name, {})
+    metadata_fields = {
+        name: metadata_field_config(name, config)
+        for name, config in metadata_fields.items()
+    }
+    for name, config in metadata_fields.items():
+        params = {"max_length": config["max_length"]} if config["max_length"] else {}
+        fields.append(
+            FieldSchema(
+                name=name,
+                dtype=METADATA_FIELD_TYPES[config["type"]][0],
+                description=f"metadata {name}",
+                **params,
+            )
+        )
     schema = CollectionSchema(fields=fields, description="reverse image search")
     collection = Collection(name=collection_name, schema=schema)
 
+    if index is None:
+        index = INDEX_CONFIGS.get(collection_name, {})
+    config = index_config(**index)
     index_params = {
-        "metric_type": "L2",
-        "index_type": "IVF_FLAT",
-        "params": {"nlist": 2048},
+        "metric_type": config["metric_type"],
+        "index_type": config["index_type"],
+        "params": config["params"],
     }
     collection.create_index(field_name=embedding_field_name, index_params=index_params)
+    for name, config in metadata_fields.items():
+        if config["index"]:
+            collection.create_index(field_name=name, index_name=f"{name}_index")
 
     collection.load()
     return collection
 
 
+def metadata_field_config(name, config):
+    "Returns the type, max_length and index of a field declared in METADATA_FIELDS"
+    if isinstance(config, str):
+        config = {"type": config}
+    if name in RESERVED_FIELDS or not name.isidentifier():
+        raise ValueError(f"Invalid metadata field name {name}")
+    if config.get("type") not in METADATA_FIELD_TYPES:
+        raise ValueError(
+            f"Unsupported type of metadata field {name}, "
+            f"expected one of {', '.join(METADATA_FIELD_TYPES)}"
+        )
+    return {
+        "type": config["type"],
+        "max_length": config.get("max_length", 256)
+        if config["type"] == "VARCHAR"
+        else None,
+        "index": config.get("index", False),
+    }
+
+
+def metadata_fields(collection):
+    "Returns the fields of the collection copied from the metadata"
+    return [
+        field for field in collection.schema.fields if field.name not in RESERVED_FIELDS
+    ]
+
+
+def metadata_value(field, metadata):
+    """
+    Returns the value of the metadata field. A missing value is replaced by the
+    default one of its type, and one of the wrong type raises a ValueError.
+    """
+    _, cast, default = METADATA_FIELD_TYPES[field.dtype.name]
+    value = (metadata or {}).get(field.name)
+    if value is None:
+        return default
+    if isinstance(value, (dict, list)) or (cast is not str and isinstance(value, str)):
+        raise ValueError(
+            f"Metadata {field.name} must be a {field.dtype.name}, "
+            f"not {json.dumps(value)}"
+        )
+    value = cast(value)
+    if cast is str:
+        # max_length is a number of bytes, the value is truncated to the last
+        # complete character
+        value = value.encode()[: field.params["max_length"]].decode(errors="ignore")
+    return value
+
+
+def metadata_values(collection, metadata):
+    "Returns the values of the metadata fields of the collection for a metadata"
+    return [metadata_value(field, metadata) for field in metadata_fields(collection)]
+
+
+def metadata_columns(collection, metadatas):
+    "Returns the values of the metadata fields of the collection, for each metadata"
+    return [
+        [metadata_value(field, metadata) for metadata in metadatas]
+        for field in metadata_fields(collection)
+    ]
+
+
+def vector_index(collection):
+    "Returns the index of the embeddings, collections may have scalar ones too"
+    return next(
+        index for index in collection.indexes if index.field_name == "embedding"
+    )
+
+
+def embedding_dim(collection):
+    return next(
+        field.params["dim"]
+        for field in collection.schema.fields
+        if field.name == "embedding"
+    )
+
+
+def has_hashed_keys(collection):
+    return collection.schema.primary_field.name == "id"
+
+
+def url_key(url):
+    """
+    Returns the primary key of the url in collections with hashed keys: a
+    signed 64 bits hash of the url, whose scheme and host are case insensitive.
+    """
+    parts = urlsplit(url.strip())
+    parts = parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower())
+    digest = hashlib.blake2b(urlunsplit(parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def primary_key(collection, url):
+    "Returns the primary key of the url in the collection, urls sharing it are alike"
+    return url_key(url) if has_hashed_keys(collection) else url
+
+
+def format_url_list(urls):
+    quoted_urls = [f'"{url}"' for url in urls]
+    return f'[{",".join(quoted_urls)}]'
+
+
+def urls_expr(collection, urls):
+    "Returns the expression matching the entities of the urls"
+    if has_hashed_keys(collection):
+        return f"id in {[url_key(url) for url in urls]}"
+    return f"url in {format_url_list(urls)}"
+
+
+def cursor_expr(collection, cursor):
+    """
+    Returns the expression matching the entities following the url cursor, in
+    the order of the primary keys, in which queries return entities
+    """
+    if has_hashed_keys(collection):
+        return f"id > {url_key(cursor)}" if cursor else f"id >= {-(2**63)}"
+    return f'url > "{cursor}"'
+
+
+def entity_columns(collection, urls, embeddings, metadatas):
+    "Returns the columns to insert in the collection, in the order of its fields"
+    columns = [urls, embeddings, [json.dumps(metadata) for metadata in metadatas]]
+    if has_hashed_keys(collection):
+        columns.insert(0, [url_key(url) for url in urls])
+    return columns + metadata_columns(collection, metadatas)
+
+
+def ensure_partition(collection, partition_name):
+    if not collection.has_partition(partition_name):
+        collection.create_partition(partition_name)
+        # Loads the new partition along the others
+        collection.load()
+
+
+def check_partitions(collection, partition_names):
+    missing = set(partition_names) - {p.name for p in collection.partitions}
+    if missing:
+        raise ValueError(f"Unknown partitions {', '.join(sorted(missing))}")
+
+
 def destroy_all_data_from_all_collections_in_the_whole_database():
     ensure_connection()
     for c in utility.list_collections():
         utility.drop_collection(c)
 
 
-collections = {
-    name: get_collection(name, dim) for name, dim in embedding_dimensions.items()
-}
-metrics = {
-    name: collection.index()._index_params["metric_type"]
-    for name, collection in collections.items()
-}
+@functools.cache
+def supports_count_query():
+    "Returns whether the server supports count(*) queries, if its version is known"
+    version = utility.get_server_version()
+    match = re.match(r"v?(\d+)\.(\d+)\.(\d+)", version)
+    if match is None:
+        return True
+    return tuple(int(number) for number in match.groups()) >= COUNT_QUERY_VERSION
+
+
+def get_metric(collection_name):
+    return vector_index(collections[collection_name])._index_params["metric_type"]
+
+
+def index_config(
+    index_type="IVF_FLAT", params=None, search_params=None, metric_type="L2"
+):
+    """
+    Returns the index type, and its build and search parameters completed with
+    the default ones.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(
+            f"Unsupported index type {index_type}, "
+            f"expected one of {', '.join(INDEX_TYPES)}"
+        )
+    if metric_type not in METRIC_TYPES:
+        raise ValueError(
+            f"Unsupported metric type {metric_type}, "
+            f"expected one of {', '.join(METRIC_TYPES)}"
+        )
+    default_params, default_search_params = INDEX_TYPES[index_type]
+    return {
+        "index_type": index_type,
+        "metric_type": metric_type,
+        "params": {**default_params, **(params or {})},
+        "search_params": {**default_search_params, **(search_params or {})},
+    }
+
+
+def check_index_params(config, dim):
+    """
+    Raises a ValueError if the build parameters of the index config are unknown
+    to its type or out of their range, as Milvus would only once the previous
+    index is dropped.
+    """
+    default_params, _ = INDEX_TYPES[config["index_type"]]
+    for name, value in config["params"].items():
+        if name not in default_params:
+            raise ValueError(
+                f"Unsupported parameter {name} for {config['index_type']}, "
+                f"expected {', '.join(default_params)}"
+            )
+        low, high = INDEX_PARAM_RANGES[name]
+        if type(value) is not int or not low <= value <= high:
+            raise ValueError(f"{name} must be an integer in [{low}, {high}]")
+    if dim % config["params"].get("m", 1):
+        raise ValueError(f"m must divide the dimension {dim}")
+
+
+def configured_search_params(collection_name, index_type):
+    """
+    Returns the search parameters of INDEX_CONFIGS for an index of the given
+    type, or the default ones if another type is configured.
+    """
+    config = INDEX_CONFIGS.get(collection_name, {})
+    if config.get("index_type", "IVF_FLAT") != index_type:
+        config = {"index_type": index_type}
+    return index_config(**config)["search_params"]
+
+
+def get_search_params(collection_name):
+    """
+    Returns the search parameters suited to the current index of the
+    collection, which may have been rebuilt with another type than configured.
+    """
+    search_params = search_params_cache.get(collection_name)
+    if search_params is None:
+        index = vector_index(collections[collection_name])
+        search_params = configured_search_params(
+            collection_name, index._index_params["index_type"]
+        )
+        search_params_cache.put(collection_name, search_params)
+    return search_params
+
+
+def rebuild_index(collection_name, index_type, params=None):
+    """
+    Replaces the index of the collection with one of the given type, keeping
+    its metric. The collection is released while the index is built in the
+    background, so searches fail until it is loaded again, see index_status.
+    Searches use the parameters of INDEX_CONFIGS if the type is the configured
+    one, and the default ones of the type otherwise. If the build fails, the
+    previous index is restored and the error reported by index_status.
+    """
+    config = index_config(
+        index_type,
+        params,
+        configured_search_params(collection_name, index_type),
+        metrics[collection_name],
+    )
+    collection = collections[collection_name]
+    check_index_params(config, embedding_dim(collection))
+    if not maintenance_lock.acquire(blocking=False):
+        raise ValueError("This worker is already rebuilding or migrating a collection")
+    try:
+        index_params = {
+            "metric_type": config["metric_type"],
+            "index_type": config["index_type"],
+            "params": config["params"],
+        }
+        previous_params = dict(vector_index(collection)._index_params)
+        rebuild_errors.pop(collection_name, None)
+        collection.release()
+        collection.drop_index(index_name=vector_index(collection).index_name)
+    except BaseException:
+        maintenance_lock.release()
+        raise
+
+    def build():
+        try:
+            start = time.perf_counter()
+            collection.create_index(field_name="embedding", index_params=index_params)
+            built = time.perf_counter()
+            collection.load()
+            search_params_cache.put(collection_name, config["search_params"])
+            end = time.perf_counter()
+            print(
+                f"Rebuilt {config['index_type']} index of {collection_name} "
+                f"in {end - start:.2f}s (build: {built - start:.2f}s, "
+                f"load: {end - built:.2f}s)"
+            )
+        except Exception as e:
+            print(f"Failed to rebuild the index of {collection_name}: {e}")
+            rebuild_errors[collection_name] = str(e)
+            restore_index(collection, previous_params)
+        finally:
+            maintenance_lock.release()
+
+    threading.Thread(target=build, daemon=True).start()
+    return config
+
+
+def restore_index(collection, index_params):
+    "Recreates the index of the given parameters after a failed rebuild"
+    try:
+        collection.release()
+        if any(index.field_name == "embedding" for index in collection.indexes):
+            collection.drop_index(index_name=vector_index(collection).index_name)
+        collection.create_index(field_name="embedding", index_params=index_params)
+        collection.load()
+        search_params_cache.put(
+            collection.name,
+            configured_search_params(collection.name, index_params["index_type"]),
+        )
+        print(f"Restored the {index_params['index_type']} index of {collection.name}")
+    except Exception as e:
+        print(f"Failed to restore the index of {collection.name}: {e}")
+
+
+def index_status(collection_name):
+    """
+    Returns the parameters of the index of the collection, and the progress of
+    its building and loading, and the error of the last rebuild by this worker
+    if it failed.
+    """
+    collection = collections[collection_name]
+    status = {"index_type": None, "params": None, "metric_type": None}
+    if any(index.field_name == "embedding" for index in collection.indexes):
+        index = vector_index(collection)
+        index_params = index._index_params
+        status = {
+            "index_type": index_params["index_type"],
+            "params": index_params["params"],
+            "metric_type": index_params["metric_type"],
+        }
+        # Ambiguous without the name if metadata fields are indexed too
+        progress = utility.index_building_progress(
+            collection_name, index_name=index.index_name
+        )
+        status["indexed_rows"] = progress["indexed_rows"]
+        status["total_rows"] = progress["total_rows"]
+    status["loading_progress"] = utility.loading_progress(collection_name)[
+        "loading_progress"
+    ]
+    status["hashed_keys"] = has_hashed_keys(collection)
+    status["rebuild_error"] = rebuild_errors.get(collection_name)
+    return status
+
+
+def migrate_to_hashed_keys(collection_name, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Copies the collection to a new one with hashed keys (see url_key), with
+    the same index, in the background. The new collection then replaces the
+    original one, which is kept renamed as a backup. Insertions and removals
+    during the migration are lost, and other workers must be restarted.
+    """
+    collection = collections[collection_name]
+    if has_hashed_keys(collection):
+        raise ValueError(f"{collection_name} already has hashed keys")
+    if not maintenance_lock.acquire(blocking=False):
+        raise ValueError("This worker is already rebuilding or migrating a collection")
+
+    index_params = vector_index(collection)._index_params
+    index = {
+        "index_type": index_params["index_type"],
+        "params": index_params["params"],
+        "metric_type": index_params["metric_type"],
+    }
+    dim = embedding_dim(collection)
+    indexed_fields = {index.field_name for index in collection.indexes}
+    fields = {
+        field.name: {
+            "type": field.dtype.name,
+            "max_length": field.params.get("max_length"),
+            "index": field.name in indexed_fields,
+        }
+        for field in metadata_fields(collection)
+    }
+    target_name = f"{collection_name}__hashed"
+    backup_name = f"{collection_name}__backup_{int(time.time())}"
+
+    def migrate():
+        try:
+            start = time.perf_counter()
+            # Left over by an interrupted migration
+            if utility.has_collection(target_name):
+                utility.drop_collection(target_name)
+            target = get_collection(target_name, dim, index, True, fields)
+            migrated = 0
+            for partition in collection.partitions:
+                ensure_partition(target, partition.name)
+                cursor = ""
+                while True:
+                    entities = collection.query(
+                        cursor_expr(collection, cursor),
+                        consistency_level="Strong",
+                        limit=batch_size,
+                        output_fields=["url", "embedding", "metadata"],
+                        partition_names=[partition.name],
+                    )
+                    if not entities:
+                        break
+                    target.insert(
+                        entity_columns(
+                            target,
+                            [entity["url"] for entity in entities],
+                            [entity["embedding"] for entity in entities],
+                            [json.loads(entity["metadata"]) for entity in entities],
+                        ),
+                        partition_name=partition.name,
+                    )
+                    cursor = entities[-1]["url"]
+                    migrated += len(entities)
+                    print(f"Migrated {migrated} entities of {collection_name}")
+            target.flush()
+
+            collection.release()
+            utility.rename_collection(collection_name, backup_name)
+            utility.rename_collection(target_name, collection_name)
+            collections[collection_name] = get_collection(collection_name, dim)
+            print(
+                f"Migrated {collection_name} to hashed keys in "
+                f"{time.perf_counter() - start:.2f}s, the original collection "
+                f"is kept as {backup_name}"
+            )
+        except Exception as e:
+            print(f"Failed to migrate {collection_name}: {e}")
+        finally:
+            maintenance_lock.release()
+
+    threading.Thread(target=migrate, daemon=True).start()
+    return {"collection": collection_name, "backup": backup_name}
+
+
+# Collections are connected to and loaded on first use
+collections = Registry(
+    {
+        name: functools.partial(get_collection, name, dim)
+        for name, dim in embedding_dimensions.items()
+    },
+    "collection",
+)
+metrics = Registry(
+    {name: functools.partial(get_metric, name) for name in embedding_dimensions}
+)
+search_params_cache = TTLCache(256, INDEX_CACHE_TTL)
+# Error of the last failed rebuild_index of each collection
+rebuild_errors = {}
+maintenance_lock = threading.Lock()
@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from cache import embedding_cache
+from embeddings import backends, open_image, embeddings
+from fetch import download_image
+
+# Number of images downloaded concurrently by a pipeline
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 8))
+
+# Number of images waiting between two stages of a pipeline. It bounds the
+# memory used by a pipeline when one stage is slower than the others.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 32))
+
+_END = object()
+
+
+def cache_key(model_name, data):
+    # Embeddings differ between backends, see EmbeddingCache.key
+    return embedding_cache.key(model_name, data, backends.get(model_name, "torch"))
+
+
+def _put(stage_queue, item, stopped):
+    # Blocking put that gives up when the pipeline is stopped by its consumer
+    while not stopped.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(stage_queue, stopped):
+    # Blocking get that gives up when the pipeline is stopped by its consumer
+    while not stopped.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def _fetch(urls, executor, fetched, stopped):
+    # Futures are queued in the order of the urls, so that the following
+    # stages preserve it. The bounded queue limits the downloads in flight.
+    for url in urls:
+        if stopped.is_set():
+            return
+        _put(fetched, (url, executor.submit(download_image, url)), stopped)
+    _put(fetched, _END, stopped)
+
+
+def _decode(model_name, model, fetched, decoded, stopped):
+    # Images found in the cache skip the decoding and inference stages
+    while True:
+        item = _get(fetched, stopped)
+        if item is _END:
+            break
+        url, future = item
+        try:
+            data = future.result()
+            key = cache_key(model_name, data)
+            embedding = embedding_cache.get(key)
+            if embedding is None:
+                image = open_image(data, model.input_size)
+                pixel_values = model.preprocess([image])
+                _put(decoded, (url, key, pixel_values, None, None), stopped)
+            else:
+                _put(decoded, (url, key, None, embedding, None), stopped)
+        except Exception as e:
+            _put(decoded, (url, None, None, None, e), stopped)
+    _put(decoded, _END, stopped)
+
+
+def _infer(model, pending):
+    # Returns the pending entries in order, with the embeddings filled in
+    ready = [entry for entry in pending if entry[2] is not None]
+    if not ready:
+        return pending
+    try:
+        batch_embeddings = model.get_image_embeddings_from_pixels(
+            torch.cat([entry[2] for entry in ready])
+        )
+    except Exception:
+        # Isolate the image(s) responsible for the failure
+        batch_embeddings = []
+        for entry in ready:
+            try:
+                batch_embeddings.append(
+                    model.get_image_embeddings_from_pixels(entry[2])[0]
+                )
+            except Exception as e:
+                batch_embeddings.append(e)
+    for entry, embedding in zip(ready, batch_embeddings):
+        entry[2] = None
+        if isinstance(embedding, Exception):
+            entry[4] = embedding
+        else:
+            entry[3] = embedding
+            embedding_cache.put(entry[1], embedding)
+    return pending
+
+
+def embed_urls(
+    model_name,
+    urls,
+    batch_size,
+    fetch_concurrency=FETCH_CONCURRENCY,
+    queue_size=PIPELINE_QUEUE_SIZE,
+):
+    """
+    Computes the embeddings of the images at the given urls, as a generator of
+    (url, embedding, error) tuples in the order of the urls. Exactly one of
+    embedding and error is None.
+
+    Downloads, decoding/preprocessing and batched inference run as concurrent
+    stages joined by bounded queues, so that waiting for image servers and
+    computing embeddings overlap.
+    """
+    model = embeddings[model_name]
+    fetched = queue.Queue(maxsize=queue_size)
+    decoded = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    executor = ThreadPoolExecutor(max_workers=fetch_concurrency)
+    stages = [
+        threading.Thread(
+            target=_fetch, args=(urls, executor, fetched, stopped), daemon=True
+        ),
+        threading.Thread(
+            target=_decode,
+            args=(model_name, model, fetched, decoded, stopped),
+            daemon=True,
+        ),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        pending = []  # [url, cache key, pixel_values, embedding, error]
+        ready_count = 0
+        while True:
+            item = decoded.get()
+            if item is not _END:
+                pending.append(list(item))
+                ready_count += item[2] is not None
+                if ready_count < batch_size:
+                    continue
+            for url, _, _, embedding, error in _infer(model, pending):
+                yield url, embedding, error
+            if item is _END:
+                return
+            pending = []
+            ready_count = 0
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def embed_url(model_name, url):
+    data = download_image(url)
+    key = cache_key(model_name, data)
+    embedding = embedding_cache.get(key)
+    if embedding is None:
+        model = embeddings[model_name]
+        image = open_image(data, model.input_size)
+        embedding = model.image_batcher.submit(model.preprocess([image]))
+        embedding_cache.put(key, embedding)
+    return embedding
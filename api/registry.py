@@ -0,0 +1,28 @@
+import threading
+import time
+
+
+class Registry(dict):
+    """
+    Dictionary whose values are only created on first access, by the factory
+    registered for their key. It lets the worker load models and collections
+    when they are actually used rather than at import time.
+    """
+
+    def __init__(self, factories, label=None):
+        super().__init__()
+        self.factories = factories
+        self.label = label
+        self.lock = threading.RLock()
+
+    def __missing__(self, key):
+        factory = self.factories[key]  # KeyError for unknown keys, as for a dict
+        with self.lock:
+            # Another thread may have created it while waiting for the lock
+            if not dict.__contains__(self, key):
+                start = time.perf_counter()
+                self[key] = factory()
+                if self.label:
+                    duration = time.perf_counter() - start
+                    print(f"Loaded {self.label} {key} in {duration:.2f}s")
+            return dict.__getitem__(self, key)
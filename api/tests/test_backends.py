@@ -0,0 +1,26 @@
+import pytest
+
+from ..embeddings import CLIP, embeddings
+
+MODEL_PATH = "openai/clip-vit-base-patch32"
+
+
+def cosine(left, right):
+    return sum(x * y for x, y in zip(left, right))
+
+
+@pytest.mark.parametrize("backend", ["quantized", "onnx", "onnx_int8"])
+def test_backend_agrees_with_torch(backend):
+    if backend.startswith("onnx"):
+        pytest.importorskip("onnxruntime")
+    clip = CLIP(MODEL_PATH, backend)
+
+    text = "a black and white text in japanese"
+    assert 0.98 < cosine(
+        clip.get_text_embedding(text), embeddings["vit_b32"].get_text_embedding(text)
+    )
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        CLIP(MODEL_PATH, "tensorflow")
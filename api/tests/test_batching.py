@@ -0,0 +1,69 @@
+import pytest
+import threading
+from unittest.mock import MagicMock
+
+from ..batching import MicroBatcher
+
+
+def double_all(items):
+    if "fail" in items:
+        raise ValueError("fail")
+    return [item * 2 for item in items]
+
+
+def submit_concurrently(batcher, items):
+    results = [None] * len(items)
+
+    def submit(i):
+        try:
+            results[i] = batcher.submit(items[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_micro_batcher_gathers_concurrent_items():
+    process = MagicMock(side_effect=double_all)
+    batcher = MicroBatcher(process, max_batch_size=4, window=1)
+
+    assert [2, 4, 6, 8] == submit_concurrently(batcher, [1, 2, 3, 4])
+    process.assert_called_once()
+    assert [1, 2, 3, 4] == sorted(process.call_args.args[0])
+
+
+def test_micro_batcher_respects_max_batch_size():
+    process = MagicMock(side_effect=double_all)
+    batcher = MicroBatcher(process, max_batch_size=2, window=1)
+
+    assert [2, 4, 6, 8, 10] == submit_concurrently(batcher, [1, 2, 3, 4, 5])
+    assert all(len(call.args[0]) <= 2 for call in process.call_args_list)
+
+
+def test_micro_batcher_isolates_failures():
+    batcher = MicroBatcher(double_all, max_batch_size=3, window=1)
+
+    results = submit_concurrently(batcher, [1, "fail", 3])
+    assert [2, 6] == [results[0], results[2]]
+    assert isinstance(results[1], ValueError)
+
+
+def test_micro_batcher_submit_many():
+    batcher = MicroBatcher(double_all, max_batch_size=8, window=0.01)
+    assert [2, 4, 6] == batcher.submit_many([1, 2, 3])
+
+
+def test_disabled_micro_batcher():
+    process = MagicMock(side_effect=double_all)
+    batcher = MicroBatcher(process, max_batch_size=1)
+
+    assert 2 == batcher.submit(1)
+    process.assert_called_once_with([1])
+    assert batcher.thread is None
+    with pytest.raises(ValueError):
+        batcher.submit("fail")
@@ -0,0 +1,83 @@
+from ..cache import EmbeddingCache, TTLCache, normalize_text
+
+
+def test_embedding_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), 2**20)
+    key = cache.key("vit_b32", b"image bytes")
+
+    assert cache.get(key) is None
+    cache.put(key, [0.5, -0.25, 1.0])
+    assert [0.5, -0.25, 1.0] == cache.get(key)
+    assert {"hits": 1, "misses": 1, "size": 12, "max_size": 2**20} == cache.stats()
+
+
+def test_embedding_cache_keys_depend_on_the_model():
+    assert EmbeddingCache.key("vit_b32", b"image") != EmbeddingCache.key(
+        "vit_l14", b"image"
+    )
+    assert EmbeddingCache.key("vit_b32", b"image") == EmbeddingCache.key(
+        "vit_b32", b"image"
+    )
+
+
+def test_embedding_cache_keys_depend_on_the_backend():
+    assert EmbeddingCache.key("vit_b32", b"image") == EmbeddingCache.key(
+        "vit_b32", b"image", "torch"
+    )
+    assert EmbeddingCache.key("vit_b32", b"image") != EmbeddingCache.key(
+        "vit_b32", b"image", "onnx"
+    )
+
+
+def test_embedding_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    key = EmbeddingCache.key("vit_b32", b"image bytes")
+    EmbeddingCache(path, 2**20).put(key, [1.0] * 512)
+    assert [1.0] * 512 == EmbeddingCache(path, 2**20).get(key)
+
+
+def test_embedding_cache_evicts_least_recently_used(tmp_path):
+    # room for 3 embeddings of 512 float32
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), 3 * 2048)
+    keys = [cache.key("vit_b32", bytes([i])) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, [0.0] * 512)
+    cache.get(keys[0])
+    cache.put(keys[3], [0.0] * 512)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[3]) is not None
+    assert cache.stats()["size"] <= 3 * 2048
+
+
+def test_disabled_embedding_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), 0)
+    key = cache.key("vit_b32", b"image bytes")
+    cache.put(key, [1.0])
+    assert cache.get(key) is None
+    assert not (tmp_path / "cache.sqlite3").exists()
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert 1 == cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert 1 == cache.get("a")
+    assert 3 == cache.get("c")
+    assert {"hits": 3, "misses": 1, "size": 2, "max_size": 2} == cache.stats()
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(2, -1)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    assert 0 == cache.stats()["size"]
+
+
+def test_normalize_text():
+    assert "a cute cat" == normalize_text("  A cute\n  CAT ")
@@ -1,10 +1,28 @@
 import pytest
-from ..commands import commands
+from ..commands import (
+    commands,
+    get_text_embeddings,
+    search_by_embedding,
+    warm_up,
+    CONSISTENCY_LEVELS,
+)
+from .. import commands as commands_module
+from cache import text_cache
 from embeddings import embeddings
-from milvus import collections, metrics, get_collection
+from milvus import (
+    collections,
+    metrics,
+    get_collection,
+    has_hashed_keys,
+    maintenance_lock,
+    url_key,
+)
 from pymilvus import utility
+import json
 import numpy as np
+import time
 
+from contextlib import ExitStack
 from unittest.mock import patch
 
 
@@ -14,17 +32,53 @@ TEST_URLS = [
     "https://ids.lib.harvard.edu/ids/iiif/44405790/full/full/0/native.jpg",
 ]
 
+# Images are decoded at a reduced resolution before being embedded (see
+# embeddings.open_image), which slightly changes the similarities
+SIMILARITY_TOLERANCE = 1
+
+
+@pytest.fixture(autouse=True)
+def strong_consistency():
+    # Tests read what they have just written
+    with patch.dict(CONSISTENCY_LEVELS, {key: "Strong" for key in CONSISTENCY_LEVELS}):
+        yield
+
 
 @pytest.fixture
-def mock_model():
-    TEST_MODEL_NAME = "mock_vit_b32"
-    if utility.has_collection(TEST_MODEL_NAME):
-        utility.drop_collection(TEST_MODEL_NAME)
-    test_collection = get_collection(TEST_MODEL_NAME, 512)
-    with patch.dict(embeddings, {TEST_MODEL_NAME: embeddings["vit_b32"]}):
-        with patch.dict(metrics, {TEST_MODEL_NAME: "L2"}):
-            with patch.dict(collections, {TEST_MODEL_NAME: test_collection}):
-                yield TEST_MODEL_NAME
+def mock_models():
+    """
+    Returns a function creating a model using the embeddings of vit_b32 with a
+    new collection, given the arguments of get_collection besides its name and
+    dimension, and returning the name of the model.
+    """
+    with ExitStack() as stack:
+
+        def mock(model_name, **kwargs):
+            if utility.has_collection(model_name):
+                utility.drop_collection(model_name)
+            collection = get_collection(model_name, 512, **kwargs)
+            metric = (kwargs.get("index") or {}).get("metric_type", "L2")
+            for registry, value in [
+                (embeddings, embeddings["vit_b32"]),
+                (metrics, metric),
+                (collections, collection),
+            ]:
+                stack.enter_context(patch.dict(registry, {model_name: value}))
+            return model_name
+
+        yield mock
+
+
+@pytest.fixture
+def mock_model(mock_models):
+    return mock_models("mock_vit_b32")
+
+
+# Metadata fields of the collections of filtered searches
+TEST_METADATA_FIELDS = {
+    "language": {"type": "VARCHAR", "max_length": 16, "index": True},
+    "year": "INT64",
+}
 
 
 def test_crud(mock_model):
@@ -36,25 +90,25 @@ def test_crud(mock_model):
 
     assert [TEST_URLS[0]] == commands["list_images"](mock_model)
 
-    assert 1 == commands["count"](mock_model)
+    assert 1 == commands["count"](mock_model, exact=True)
 
     assert [
         {
-            "similarity": pytest.approx(55.82546989213125),
+            "similarity": pytest.approx(55.82546989213125, abs=SIMILARITY_TOLERANCE),
             "metadata": metadata,
             "url": TEST_URLS[0],
         }
     ] == commands["search_by_url"](mock_model, TEST_URLS[1])
     assert [
         {
-            "similarity": pytest.approx(29.19090986251831),
+            "similarity": pytest.approx(29.19090986251831, abs=SIMILARITY_TOLERANCE),
             "metadata": metadata,
             "url": TEST_URLS[0],
         }
     ] == commands["search_by_text"](mock_model, "a black and white text in japanese")
     assert [
         {
-            "similarity": pytest.approx(17.36249327659607),
+            "similarity": pytest.approx(17.36249327659607, abs=SIMILARITY_TOLERANCE),
             "metadata": metadata,
             "url": TEST_URLS[0],
         }
@@ -64,7 +118,7 @@ def test_crud(mock_model):
 
     assert [] == commands["list_images"](mock_model)
 
-    assert 0 == commands["count"](mock_model)
+    assert 0 == commands["count"](mock_model, exact=True)
 
 
 def test_insert_nothing(mock_model):
@@ -102,7 +156,7 @@ def test_remove_multiple_images(mock_model):
 
     assert [] == commands["list_images"](mock_model)
 
-    assert 0 == commands["count"](mock_model)
+    assert 0 == commands["count"](mock_model, exact=True)
 
 
 def test_insert_without_replacing(mock_model):
@@ -131,8 +185,294 @@ def test_insert_without_replacing(mock_model):
     commands["remove_images"](mock_model, [TEST_URLS[0], TEST_URLS[1]])
 
 
+def test_insert_in_batches(mock_model):
+    result = commands["insert_images"](
+        mock_model,
+        [TEST_URLS[0], "https://picsum.photos/128", TEST_URLS[1], TEST_URLS[2]],
+        [None] * 4,
+        fail_on_error=False,
+        batch_size=2,
+    )
+    assert [TEST_URLS[0], TEST_URLS[1], TEST_URLS[2]] == result["added"]
+    assert [("https://picsum.photos/128", "IMAGE_SIZE_TOO_SMALL")] == [
+        (entry["url"], entry["code"]) for entry in result["failed"]
+    ]
+    assert 3 == commands["count"](mock_model, exact=True)
+
+    commands["remove_images"](mock_model, [TEST_URLS[0], TEST_URLS[1], TEST_URLS[2]])
+
+
+def test_exact_count_without_count_query(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS, [None] * len(TEST_URLS))
+    with patch.object(commands_module, "supports_count_query", return_value=False):
+        assert 3 == commands["count"](mock_model, exact=True)
+    commands["remove_images"](mock_model, TEST_URLS)
+
+
+def test_inner_product_metric(mock_model, mock_models):
+    mock_ip_model = mock_models("mock_ip_vit_b32", index={"metric_type": "IP"})
+    # Scores do not depend on the metric, embeddings being normalised
+    for model_name in [mock_model, mock_ip_model]:
+        commands["insert_images"](model_name, [TEST_URLS[0]], [None])
+    l2_results = commands["search_by_url"](mock_model, TEST_URLS[1])
+    ip_results = commands["search_by_url"](mock_ip_model, TEST_URLS[1])
+    assert ip_results[0]["similarity"] == pytest.approx(
+        l2_results[0]["similarity"], abs=1e-3
+    )
+    assert commands["compare"](
+        mock_ip_model, TEST_URLS[0], TEST_URLS[1]
+    ) == pytest.approx(commands["compare"](mock_model, TEST_URLS[0], TEST_URLS[1]))
+    assert commands["index_status"](mock_ip_model)["metric_type"] == "IP"
+
+
+def test_hashed_keys(mock_models):
+    mock_hashed_model = mock_models("mock_hashed_vit_b32", hashed_keys=True)
+    metadata = {"tags": ["text"]}
+    commands["insert_images"](mock_hashed_model, TEST_URLS, [metadata] * 3)
+    assert {"added": [], "found": TEST_URLS, "failed": []} == commands[
+        "insert_images"
+    ](mock_hashed_model, TEST_URLS, [metadata] * 3, replace_existing=False)
+    # Hosts are case insensitive
+    upper_url = TEST_URLS[0].replace("https://iiif.itatti", "HTTPS://IIIF.ITATTI")
+    assert {"added": [], "found": [upper_url], "failed": []} == commands[
+        "insert_images"
+    ](mock_hashed_model, [upper_url], [metadata], replace_existing=False)
+    with patch.object(commands_module, "embed_url") as embed_url:
+        commands["compare"](mock_hashed_model, upper_url, TEST_URLS[0])
+    embed_url.assert_not_called()
+
+    assert 3 == commands["count"](mock_hashed_model, exact=True)
+    assert sorted(TEST_URLS) == sorted(commands["list_images"](mock_hashed_model))
+    first = commands["list_images"](mock_hashed_model, "", 1)
+    rest = commands["list_images"](mock_hashed_model, first[0])
+    assert sorted(TEST_URLS) == sorted(first + rest)
+
+    results = commands["search_by_url"](mock_hashed_model, TEST_URLS[0])
+    assert TEST_URLS[0] == results[0]["url"]
+    assert metadata == results[0]["metadata"]
+
+    entries = commands["list_images"](
+        mock_hashed_model, "", 10, ["url", "embedding", "metadata"]
+    )
+    assert {"url", "embedding", "metadata"} == set(entries[0])
+
+    commands["remove_images"](mock_hashed_model, TEST_URLS[:2])
+    assert [TEST_URLS[2]] == commands["list_images"](mock_hashed_model)
+
+
+def test_url_key():
+    assert url_key("HTTPS://Example.org/Image.jpg") == url_key(
+        "https://example.org/Image.jpg"
+    )
+    assert url_key("https://example.org/image.jpg") != url_key(
+        "https://example.org/Image.jpg"
+    )
+    assert -(2**63) <= url_key("https://example.org/image.jpg") < 2**63
+
+
+def test_migrate_to_hashed_keys(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS[:2], [None] * 2)
+    commands["insert_images"](mock_model, TEST_URLS[2:], [None], partition="a")
+    backup = commands["migrate_to_hashed_keys"](mock_model)["backup"]
+    for _ in range(60):
+        if not maintenance_lock.locked():
+            break
+        time.sleep(1)
+
+    assert has_hashed_keys(collections[mock_model])
+    assert sorted(TEST_URLS) == sorted(commands["list_images"](mock_model))
+    # Partitions are kept
+    assert TEST_URLS[2:] == commands["list_images"](mock_model, partitions=["a"])
+    utility.drop_collection(backup)
+
+
+def test_partitions(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS[:2], [None] * 2, partition="a")
+    commands["insert_images"](mock_model, TEST_URLS[2:], [None], partition="b")
+
+    assert sorted(TEST_URLS[:2]) == sorted(
+        commands["list_images"](mock_model, partitions=["a"])
+    )
+    assert 1 == commands["count"](mock_model, exact=True, partitions=["b"])
+    assert 3 == commands["count"](mock_model, exact=True, partitions=["a", "b"])
+    results = commands["search_by_url"](mock_model, TEST_URLS[0], partitions=["b"])
+    assert [TEST_URLS[2]] == [result["url"] for result in results]
+    assert {"_default", "a", "b"} == {
+        partition["name"] for partition in commands["list_partitions"](mock_model)
+    }
+
+    with pytest.raises(ValueError):
+        commands["search_by_url"](mock_model, TEST_URLS[0], partitions=["c"])
+
+
+def test_index_status_with_scalar_index(mock_models):
+    mock_filtered_model = mock_models(
+        "mock_filtered_vit_b32", metadata_fields=TEST_METADATA_FIELDS
+    )
+    status = commands["index_status"](mock_filtered_model)
+    assert "IVF_FLAT" == status["index_type"]
+    assert 0 == status["total_rows"]
+
+
+def test_filtered_search(mock_models):
+    mock_filtered_model = mock_models(
+        "mock_filtered_vit_b32", metadata_fields=TEST_METADATA_FIELDS
+    )
+    metadatas = [
+        {"language": "ja", "year": 1900},
+        {"language": "it", "year": 1950},
+        {"tags": ["no language"]},
+    ]
+    commands["insert_images"](mock_filtered_model, TEST_URLS, metadatas)
+
+    results = commands["search_by_text"](
+        mock_filtered_model, "a painting", expr='language == "it"'
+    )
+    assert [(TEST_URLS[1], metadatas[1])] == [
+        (result["url"], result["metadata"]) for result in results
+    ]
+    results = commands["search_by_text"](
+        mock_filtered_model, "a painting", expr="year < 1960"
+    )
+    # Missing values are 0
+    assert 3 == len(results)
+
+    with pytest.raises(ValueError):
+        commands["search_by_text"](mock_filtered_model, "a painting", expr="year <")
+    with pytest.raises(ValueError):
+        commands["insert_images"](
+            mock_filtered_model, [TEST_URLS[0]], [{"year": "nineteen hundred"}]
+        )
+
+
+def test_invalid_metadata_only_fails_its_image(mock_models):
+    mock_filtered_model = mock_models(
+        "mock_filtered_vit_b32", metadata_fields=TEST_METADATA_FIELDS
+    )
+    # Longer than the 16 bytes of the field once encoded
+    language = "日本語・イタリア語"
+    result = commands["insert_images"](
+        mock_filtered_model,
+        TEST_URLS[:2],
+        [{"year": "1900"}, {"language": language}],
+        fail_on_error=False,
+    )
+    assert [TEST_URLS[1]] == result["added"]
+    assert [TEST_URLS[0]] == [failure["url"] for failure in result["failed"]]
+
+    results = commands["search_by_text"](
+        mock_filtered_model, "a painting", expr='language == "日本語・イ"'
+    )
+    assert [TEST_URLS[1]] == [result["url"] for result in results]
+
+
+def test_insert_replaces_existing(mock_model):
+    commands["insert_images"](mock_model, [TEST_URLS[0]], [{"version": 1}])
+    commands["insert_images"](mock_model, [TEST_URLS[0]] * 2, [{"version": 2}] * 2)
+
+    results = commands["search_by_url"](mock_model, TEST_URLS[0])
+    assert [(TEST_URLS[0], {"version": 2})] == [
+        (result["url"], result["metadata"]) for result in results
+    ]
+    collections[mock_model].flush()
+    assert 1 == commands["count"](mock_model, exact=True)
+
+
+def test_deduplicate(mock_model):
+    # Duplicates inserted by earlier versions
+    collection = collections[mock_model]
+    embedding = list(np.ones(512) / np.sqrt(512))
+    for version in range(2):
+        collection.insert([[TEST_URLS[0]], [embedding], [json.dumps(version)]])
+    commands["insert_images"](mock_model, [TEST_URLS[1]], [None], [embedding])
+
+    commands["deduplicate"](mock_model)
+    for _ in range(60):
+        if not maintenance_lock.locked():
+            break
+        time.sleep(1)
+
+    results = search_by_embedding(mock_model, embedding)
+    assert sorted(TEST_URLS[:2]) == sorted(result["url"] for result in results)
+
+
+def test_search_by_stored_embedding(mock_model):
+    # Not the embedding of the image, so that reusing it can be told apart
+    embedding = list(np.ones(512) / np.sqrt(512))
+    commands["insert_images"](mock_model, [TEST_URLS[0]], [None], [embedding])
+    with patch.object(commands_module, "embed_url") as embed_url:
+        results = commands["search_by_url"](mock_model, TEST_URLS[0])
+        assert pytest.approx(100) == commands["compare"](
+            mock_model, TEST_URLS[0], TEST_URLS[0]
+        )
+    embed_url.assert_not_called()
+    assert TEST_URLS[0] == results[0]["url"]
+    assert pytest.approx(100) == results[0]["similarity"]
+
+    results = commands["search_by_url"](mock_model, TEST_URLS[0], use_stored=False)
+    assert results[0]["similarity"] < 90
+
+
+def test_search_batch(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS[:2], [None] * 2)
+    queries = [
+        {"url": TEST_URLS[0]},
+        {"text": "a letter in japanese"},
+        {"url": "https://picsum.photos/128"},
+        {"url": TEST_URLS[2]},
+        {"url": TEST_URLS[0]},
+    ]
+    results = commands["search_batch"](mock_model, queries, 2)
+    assert 5 == len(results)
+    assert results[0] == results[4]
+    assert results[0] == {
+        "results": commands["search_by_url"](mock_model, TEST_URLS[0], 2)
+    }
+    assert results[1] == {
+        "results": commands["search_by_text"](mock_model, "a letter in japanese", 2)
+    }
+    assert results[2] == {
+        "error": "Images must have their dimensions above 150 x 150 pixels",
+        "code": "IMAGE_SIZE_TOO_SMALL",
+    }
+    expected = commands["search_by_url"](mock_model, TEST_URLS[2], 2)
+    assert [result["url"] for result in expected] == [
+        result["url"] for result in results[3]["results"]
+    ]
+
+
+def test_search_with_reranking(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS, [None] * len(TEST_URLS))
+    expected = commands["search_by_text"](mock_model, "a map", 2)
+    results = commands["search_by_text"](
+        mock_model, "a map", 2, search_params={"nprobe": 1}, oversample=3
+    )
+    assert [result["url"] for result in expected] == [
+        result["url"] for result in results
+    ]
+    for result, expected_result in zip(results, expected):
+        assert pytest.approx(expected_result["similarity"], abs=1e-3) == (
+            result["similarity"]
+        )
+
+
+def test_text_embeddings_are_cached():
+    texts = ["a cute colorful cat", "A  cute colorful CAT", "a map"]
+    with patch.dict(text_cache.entries, clear=True):
+        embeddings_ = get_text_embeddings("vit_b32", texts)
+        assert 2 == len(text_cache.entries)
+        assert embeddings_[0] == embeddings_[1]
+        assert pytest.approx(embeddings_[2], abs=1e-5) == embeddings[
+            "vit_b32"
+        ].get_text_embedding("a map")
+
+        hits = text_cache.hits
+        assert embeddings_ == get_text_embeddings("vit_b32", texts)
+        assert hits + 3 == text_cache.hits
+
+
 def test_compare():
-    assert pytest.approx(55.82546989213125) == commands["compare"](
+    assert pytest.approx(55.82546989213125, abs=SIMILARITY_TOLERANCE) == commands["compare"](
         "vit_b32", TEST_URLS[0], TEST_URLS[1]
     )
 
@@ -235,5 +575,100 @@ def test_list_with_output_fields(mock_model):
     commands["remove_images"](mock_model, [TEST_URLS[0]])
 
 
+def test_rebuild_index(mock_model):
+    commands["insert_images"](mock_model, [TEST_URLS[0]], [None])
+    assert "IVF_FLAT" == commands["index_status"](mock_model)["index_type"]
+
+    config = commands["rebuild_index"](mock_model, "HNSW", {"M": 8})
+    assert config == {
+        "index_type": "HNSW",
+        "metric_type": "L2",
+        "params": {"M": 8, "efConstruction": 256},
+        "search_params": {"ef": 128},
+    }
+    for _ in range(60):
+        status = commands["index_status"](mock_model)
+        if status["loading_progress"] == "100%":
+            break
+        time.sleep(1)
+    assert status["index_type"] == "HNSW"
+    assert status["metric_type"] == "L2"
+    assert status["params"] == {"M": 8, "efConstruction": 256}
+    assert status["rebuild_error"] is None
+
+    assert [TEST_URLS[0]] == [
+        result["url"] for result in commands["search_by_url"](mock_model, TEST_URLS[0])
+    ]
+    # More than the ef of 128
+    assert [TEST_URLS[0]] == [
+        result["url"]
+        for result in commands["search_by_url"](mock_model, TEST_URLS[0], 200)
+    ]
+
+
+def test_rebuild_index_invalid_type(mock_model):
+    with pytest.raises(ValueError):
+        commands["rebuild_index"](mock_model, "FLAT")
+
+
+@pytest.mark.parametrize(
+    "params", [{"ef": 64}, {"M": 2}, {"M": "16"}, {"efConstruction": 1024}]
+)
+def test_rebuild_index_invalid_params(mock_model, params):
+    with pytest.raises(ValueError):
+        commands["rebuild_index"](mock_model, "HNSW", params)
+    # The index is kept
+    status = commands["index_status"](mock_model)
+    assert "IVF_FLAT" == status["index_type"]
+    assert "100%" == status["loading_progress"]
+
+
+def test_rebuild_index_invalid_pq_params(mock_model):
+    with pytest.raises(ValueError):
+        commands["rebuild_index"](mock_model, "IVF_PQ", {"m": 48})
+
+
+def test_rebuild_index_failure(mock_model):
+    commands["insert_images"](mock_model, [TEST_URLS[0]], [None])
+    collection = collections[mock_model]
+    create_index = collection.create_index
+
+    def create_index_but_hnsw(field_name, index_params):
+        if index_params["index_type"] == "HNSW":
+            raise RuntimeError("Build failed")
+        return create_index(field_name=field_name, index_params=index_params)
+
+    with patch.object(collection, "create_index", side_effect=create_index_but_hnsw):
+        commands["rebuild_index"](mock_model, "HNSW")
+        for _ in range(60):
+            if not maintenance_lock.locked():
+                break
+            time.sleep(1)
+
+    status = commands["index_status"](mock_model)
+    assert "IVF_FLAT" == status["index_type"]
+    assert "100%" == status["loading_progress"]
+    assert "Build failed" == status["rebuild_error"]
+    assert [TEST_URLS[0]] == [
+        result["url"] for result in commands["search_by_url"](mock_model, TEST_URLS[0])
+    ]
+
+
+def test_approximate_count(mock_model):
+    commands["insert_images"](mock_model, TEST_URLS, [None] * len(TEST_URLS))
+    collections[mock_model].flush()
+    assert 3 == commands["count"](mock_model)
+    # Cached
+    commands["remove_images"](mock_model, TEST_URLS)
+    assert 3 == commands["count"](mock_model)
+    assert 0 == commands["count"](mock_model, exact=True)
+
+
+def test_warm_up():
+    warm_up(["vit_b32"])
+    assert "vit_b32" in embeddings
+    assert "vit_b32" in collections
+
+
 def test_ping():
     assert commands["ping"]() == "pong"
@@ -5,7 +5,10 @@ import random
 from PIL import Image
 import math
 
-from ..embeddings import load_image_from_url, embeddings
+from ..embeddings import load_image_from_url, open_image, embeddings
+import fetch
+import io
+import numpy as np
 
 
 def test_load_image_from_url():
@@ -27,6 +30,45 @@ def test_load_image_from_url_and_reject_small_ones():
     )
 
 
+def jpeg_bytes(size):
+    data = io.BytesIO()
+    Image.new("RGB", size, (200, 100, 50)).save(data, "JPEG")
+    return data.getvalue()
+
+
+def test_open_image_with_draft_decoding():
+    image = open_image(jpeg_bytes((4000, 3000)), 224)
+    assert min(image.size) >= 224
+    assert image.size == (500, 375)  # decoded at 1/8 of its size
+
+
+def test_open_image_without_draft_decoding():
+    image = open_image(jpeg_bytes((4000, 3000)))
+    assert image.size == (1000, 750)
+
+
+def test_open_image_rejects_too_many_pixels(monkeypatch):
+    monkeypatch.setattr(fetch, "MAX_IMAGE_PIXELS", 1000 * 1000)
+    with pytest.raises(ValueError) as exc_info:
+        open_image(jpeg_bytes((1200, 1000)))
+    assert str(exc_info.value) == "Images must have at most 1000000 pixels"
+
+
+def random_image(size):
+    image_data = bytes([random.randint(0, 255) for _ in range(size[0] * size[1] * 3)])
+    return Image.frombytes("RGB", size, image_data)
+
+
+def test_preprocess_matches_clip_processor():
+    random.seed(2023)
+    images = [random_image(size) for size in [(500, 500), (640, 480), (300, 900)]]
+    b32 = embeddings["vit_b32"]
+    expected = b32.processor(images=images, return_tensors="pt")["pixel_values"]
+    pixel_values = b32.preprocess(images)
+    assert expected.shape == pixel_values.shape
+    assert np.allclose(expected.numpy(), pixel_values.numpy(), atol=1e-5)
+
+
 def squared_l2(v):
     return sum([x * x for x in v])
 
@@ -51,6 +93,15 @@ def test_vit_b32_get_text_embedding():
     assert pytest.approx(1.223632167381993) == sum(embedding)
 
 
+def test_vit_b32_get_text_embeddings():
+    b32 = embeddings["vit_b32"]
+    texts = ["some random text", "a cat", "a black and white text in japanese"]
+    batch = b32.get_text_embeddings(texts)
+    assert 3 == len(batch)
+    for text, embedding in zip(texts, batch):
+        assert pytest.approx(embedding, abs=1e-5) == b32.get_text_embedding(text)
+
+
 @functools.cache
 def batch_test_images():
     batch_test_ids = (
@@ -83,7 +134,18 @@ def test_individual_extract(benchmark):
 
 @pytest.mark.benchmark
 def test_batch_extract(benchmark):
-    benchmark(embeddings["vit_b32"].get_image_embedding, batch_test_images())
+    benchmark(embeddings["vit_b32"].get_image_embeddings, batch_test_images())
+
+
+def test_vit_b32_get_image_embeddings():
+    images = batch_test_images()[:3]
+
+    b32 = embeddings["vit_b32"]
+    batch = b32.get_image_embeddings(images)
+    assert 3 == len(batch)
+    for image, embedding in zip(images, batch):
+        assert 512 == len(embedding)
+        assert pytest.approx(embedding, abs=1e-5) == b32.get_image_embedding(image)
 
 
 def test_unresized_image():
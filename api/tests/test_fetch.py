@@ -0,0 +1,165 @@
+import io
+import threading
+import time
+import pytest
+from PIL import Image
+from unittest.mock import MagicMock, patch
+
+from ..fetch import (
+    FetchClient,
+    HostLimiter,
+    check_content_type,
+    check_image_size,
+    download_image,
+    iiif_derivative_url,
+    read_image_size,
+)
+from common import (
+    ImageDownloadError,
+    ImageSizeTooSmallError,
+    ImageTooLargeError,
+    ImageUnsupportedTypeError,
+)
+
+
+def test_download_image():
+    data = download_image("https://picsum.photos/512")
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.size == (512, 512)
+
+
+def test_download_iiif_image():
+    data = download_image(
+        "https://ids.lib.harvard.edu/ids/iiif/44405790/full/full/0/native.jpg"
+    )
+    with Image.open(io.BytesIO(data)) as image:
+        assert max(image.size) == 448
+
+
+def test_iiif_derivative_url():
+    assert (
+        iiif_derivative_url(
+            "https://iiif.itatti.harvard.edu/iiif/2/yashiro!letters-jp!letter_001.pdf/full/full/0/default.jpg"
+        )
+        == "https://iiif.itatti.harvard.edu/iiif/2/yashiro!letters-jp!letter_001.pdf/full/!448,448/0/default.jpg"
+    )
+    assert (
+        iiif_derivative_url("https://example.org/iiif/3/id/0,0,800,600/max/0/gray.png")
+        == "https://example.org/iiif/3/id/0,0,800,600/!448,448/0/gray.png"
+    )
+    assert (
+        iiif_derivative_url("https://example.org/iiif/2/id/full/full/0/default.jpg", 0)
+        is None
+    )
+    # Already scaled, or not IIIF at all
+    assert (
+        iiif_derivative_url("https://example.org/iiif/2/id/full/600,/0/default.jpg")
+        is None
+    )
+    assert iiif_derivative_url("https://picsum.photos/512") is None
+
+
+def test_download_rejects_small_images():
+    with pytest.raises(ImageSizeTooSmallError) as exc_info:
+        download_image("https://picsum.photos/128")
+    assert (
+        str(exc_info.value)
+        == "Images must have their dimensions above 150 x 150 pixels"
+    )
+
+
+def test_download_error():
+    with pytest.raises(ImageDownloadError):
+        download_image("https://idios.invalid/image.jpg")
+
+
+def test_check_content_type():
+    check_content_type("image/jpeg")
+    check_content_type("binary/octet-stream")
+    check_content_type("")
+    with pytest.raises(ImageUnsupportedTypeError):
+        check_content_type("text/html; charset=utf-8")
+
+
+def test_check_image_size():
+    check_image_size((150, 1000))
+    with pytest.raises(ImageSizeTooSmallError):
+        check_image_size((149, 1000))
+    with pytest.raises(ImageTooLargeError):
+        check_image_size((100_000, 100_000))
+
+
+@pytest.mark.parametrize("format", ["JPEG", "PNG"])
+def test_read_image_size_from_the_header(format):
+    data = io.BytesIO()
+    Image.new("RGB", (640, 480)).save(data, format)
+    data = data.getvalue()
+
+    assert read_image_size(data[:8]) is None
+    assert (640, 480) == read_image_size(data[:1024])
+
+
+def test_host_limiter_concurrency():
+    limiter = HostLimiter(2)
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def request():
+        with limiter:
+            with lock:
+                running.append(1)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_running) == 2
+
+
+def test_host_limiter_rate():
+    limiter = HostLimiter(10, rate=20)
+    start = time.monotonic()
+    for _ in range(5):
+        with limiter:
+            pass
+    assert time.monotonic() - start >= 0.2
+
+
+def mock_response(status_code, headers={}):
+    response = MagicMock(status_code=status_code, headers=headers)
+    response.__enter__.return_value = response
+    return response
+
+
+def test_fetch_client_retries_throttled_requests():
+    client = FetchClient(retries=3, backoff=0.01)
+    responses = [
+        mock_response(429, {"Retry-After": "0"}),
+        mock_response(503),
+        mock_response(200),
+    ]
+    with patch.object(client.session, "get", side_effect=responses) as get:
+        with client.get("https://example.org/image.jpg") as response:
+            assert response.status_code == 200
+    assert get.call_count == 3
+
+
+def test_fetch_client_gives_up():
+    client = FetchClient(retries=1, backoff=0.01)
+    responses = [mock_response(503), mock_response(503)]
+    with patch.object(client.session, "get", side_effect=responses) as get:
+        with client.get("https://example.org/image.jpg") as response:
+            assert response.status_code == 503
+    assert get.call_count == 2
+
+
+def test_fetch_client_pools_per_host():
+    client = FetchClient()
+    assert client.limiter("a.org") is client.limiter("a.org")
+    assert client.limiter("a.org") is not client.limiter("b.org")
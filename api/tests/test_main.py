@@ -1,15 +1,18 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 from fastapi.testclient import TestClient
 
 from ..main import app
+from common import ImageDownloadTimeoutError, ImageSizeTooSmallError
 
 client = TestClient(app)
 
 
 @pytest.fixture
 def mock_rpc():
-    with patch("rpc_client.RpcClient.__call__") as mock_rpc:
+    with patch(
+        "rpc_client.AsyncRpcClient.__call__", new_callable=AsyncMock
+    ) as mock_rpc:
         yield mock_rpc
 
 
@@ -57,6 +60,40 @@ def test_add_image_success_no_metadata(mock_rpc):
     )
 
 
+def test_add_image_to_partition(mock_rpc):
+    mock_rpc.return_value = None
+    response = client.post(
+        "/models/vit_b32/add?partition=itatti",
+        json={"url": "http://example.com/image.jpg"},
+    )
+    assert response.status_code == 204
+    mock_rpc.assert_called_once_with(
+        "insert_images",
+        ["vit_b32", ["http://example.com/image.jpg"], [None]],
+        {"partition": "itatti"},
+    )
+
+
+def test_add_image_invalid_partition(mock_rpc):
+    response = client.post(
+        "/models/vit_b32/add?partition=not-valid",
+        json={"url": "http://example.com/image.jpg"},
+    )
+    assert response.status_code == 422
+    mock_rpc.assert_not_called()
+
+
+def test_list_images_in_partitions(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/urls?partitions=itatti&partitions=zeri",
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "list_images", ["vit_b32", None, None], {"partitions": ["itatti", "zeri"]}
+    )
+
+
 def test_add_image_invalid_url(mock_rpc):
     response = client.post(
         "/models/vit_b32/add",
@@ -132,6 +169,23 @@ def test_add_image_small_dimensions(mock_rpc):
     )
 
 
+@pytest.mark.parametrize(
+    "error",
+    [
+        ImageSizeTooSmallError("Images must have their dimensions above 150 x 150"),
+        ImageDownloadTimeoutError("Timed out"),
+    ],
+)
+def test_add_image_error_codes(mock_rpc, error):
+    mock_rpc.side_effect = error
+    response = client.post(
+        "/models/vit_b32/add",
+        json={"url": "http://example.com/image.jpg"},
+    )
+    assert response.status_code == 422
+    assert response.json() == {"detail": [{"msg": str(error), "type": error.code}]}
+
+
 def test_add_image_server_error(mock_rpc):
     mock_rpc.side_effect = RuntimeError("Server error")
     response = client.post(
@@ -247,6 +301,85 @@ def test_search_by_url_success_with_limit(mock_rpc):
     )
 
 
+def test_search_with_consistency_level(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"text": "a cat", "consistency_level": "Session"},
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "search_by_text",
+        ["vit_b32", "a cat", 10],
+        {"consistency_level": "Session"},
+    )
+
+
+def test_search_without_stored_embedding(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"url": "http://example.com/query.jpg", "use_stored_embedding": False},
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "search_by_url",
+        ["vit_b32", "http://example.com/query.jpg", 10],
+        {"use_stored": False},
+    )
+
+
+def test_search_with_reranking(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"text": "a cat", "search_params": {"nprobe": 8}, "oversample": 4},
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "search_by_text",
+        ["vit_b32", "a cat", 10],
+        {"search_params": {"nprobe": 8}, "oversample": 4},
+    )
+
+
+def test_search_in_partitions(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"url": "http://example.com/query.jpg", "partitions": ["itatti"]},
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "search_by_url",
+        ["vit_b32", "http://example.com/query.jpg", 10],
+        {"partitions": ["itatti"]},
+    )
+
+
+def test_search_with_filter(mock_rpc):
+    mock_rpc.return_value = []
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"text": "a letter", "filter": 'language == "ja"'},
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "search_by_text",
+        ["vit_b32", "a letter", 10],
+        {"expr": 'language == "ja"'},
+    )
+
+
+def test_search_invalid_consistency_level(mock_rpc):
+    response = client.post(
+        "/models/vit_b32/search",
+        json={"text": "a cat", "consistency_level": "Immediate"},
+    )
+    assert response.status_code == 422
+    mock_rpc.assert_not_called()
+
+
 def test_search_empty(mock_rpc):
     mock_rpc.return_value = []
     response = client.post(
@@ -351,6 +484,50 @@ def test_search_returns_500_when_rpc_error(mock_rpc):
     )
 
 
+def test_search_batch(mock_rpc):
+    mock_rpc.return_value = [
+        {"results": []},
+        {
+            "error": "Images must have their dimensions above 150 x 150 pixels",
+            "code": "IMAGE_SIZE_TOO_SMALL",
+        },
+    ]
+    response = client.post(
+        "/models/vit_b32/search_batch",
+        json={
+            "queries": [{"text": "a cat"}, {"url": "http://example.com/small.jpg"}],
+            "limit": 5,
+            "partitions": ["itatti"],
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"results": [], "error": None, "code": None},
+        {
+            "results": None,
+            "error": "Images must have their dimensions above 150 x 150 pixels",
+            "code": "IMAGE_SIZE_TOO_SMALL",
+        },
+    ]
+    mock_rpc.assert_called_once_with(
+        "search_batch",
+        [
+            "vit_b32",
+            [{"text": "a cat"}, {"url": "http://example.com/small.jpg"}],
+            5,
+        ],
+        {"partitions": ["itatti"]},
+    )
+
+
+def test_search_batch_returns_422_when_query_is_empty(mock_rpc):
+    response = client.post(
+        "/models/vit_b32/search_batch", json={"queries": [{"text": "a cat"}, {}]}
+    )
+    assert response.status_code == 422
+    mock_rpc.assert_not_called()
+
+
 def test_compare_returns_similarity(mock_rpc):
     mock_rpc.return_value = 0.42
     response = client.post(
@@ -364,6 +541,24 @@ def test_compare_returns_similarity(mock_rpc):
     )
 
 
+def test_compare_without_stored_embeddings(mock_rpc):
+    mock_rpc.return_value = 0.42
+    response = client.post(
+        "/models/vit_b32/compare",
+        json={
+            "url": "http://left.org",
+            "other": "http://right.org",
+            "use_stored_embeddings": False,
+        },
+    )
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "compare",
+        ["vit_b32", "http://left.org", "http://right.org"],
+        {"use_stored": False},
+    )
+
+
 def test_compare_returns_422_when_invalid_url(mock_rpc):
     response = client.post(
         "/models/vit_b32/compare",
@@ -487,6 +682,23 @@ def test_count_success(mock_rpc):
     mock_rpc.assert_called_once_with("count", ["vit_b32"])
 
 
+def test_exact_count(mock_rpc):
+    mock_rpc.return_value = 42
+    response = client.get("/models/vit_b32/count?exact=true")
+    assert response.status_code == 200
+    assert response.json() == 42
+    mock_rpc.assert_called_once_with("count", ["vit_b32"], {"exact": True})
+
+
+def test_count_with_consistency_level(mock_rpc):
+    mock_rpc.return_value = 42
+    response = client.get("/models/vit_b32/count?exact=1&consistency_level=Bounded")
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with(
+        "count", ["vit_b32"], {"exact": True, "consistency_level": "Bounded"}
+    )
+
+
 def test_list_images_returns_500_when_rpc_error(mock_rpc):
     mock_rpc.side_effect = RuntimeError("Internal server error")
     response = client.get("/models/vit_b32/count")
@@ -551,3 +763,21 @@ def test_restore_success(mock_rpc):
             [[1.0, 2.0, 3.0], []],
         ],
     )
+
+
+def test_rebuild_index(mock_rpc):
+    mock_rpc.return_value = {
+        "index_type": "HNSW",
+        "metric_type": "L2",
+        "params": {"M": 16, "efConstruction": 256},
+        "search_params": {"ef": 128},
+    }
+    response = client.post("/models/vit_b32/index", json={"index_type": "HNSW"})
+    assert response.status_code == 200
+    mock_rpc.assert_called_once_with("rebuild_index", ["vit_b32", "HNSW", None])
+
+
+def test_rebuild_index_invalid_type(mock_rpc):
+    response = client.post("/models/vit_b32/index", json={"index_type": "FLAT"})
+    assert response.status_code == 422
+    mock_rpc.assert_not_called()
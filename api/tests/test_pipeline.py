@@ -0,0 +1,50 @@
+import pytest
+
+from ..pipeline import embed_url, embed_urls
+from cache import embedding_cache
+from embeddings import embeddings, open_image
+from fetch import download_image
+
+
+TEST_URLS = [
+    "https://iiif.itatti.harvard.edu/iiif/2/yashiro!letters-jp!letter_001.pdf/full/full/0/default.jpg",
+    "https://picsum.photos/128",
+    "https://iiif.artresearch.net/iiif/2/zeri!151200%21150872_g.jpg/full/full/0/default.jpg",
+    "https://ids.lib.harvard.edu/ids/iiif/44405790/full/full/0/native.jpg",
+]
+
+
+def test_embed_urls_keeps_order_and_failures():
+    results = list(embed_urls("vit_b32", TEST_URLS, batch_size=2))
+
+    assert TEST_URLS == [url for url, _, _ in results]
+
+    _, embedding, error = results[1]
+    assert embedding is None
+    assert isinstance(error, ValueError)
+
+    # Decoded at a reduced resolution, as by the pipeline
+    model = embeddings["vit_b32"]
+    for url, embedding, error in results[:1] + results[2:]:
+        assert error is None
+        assert pytest.approx(embedding, abs=1e-5) == model.get_image_embedding(
+            open_image(download_image(url), model.input_size)
+        )
+
+
+def test_embed_urls_stops_early():
+    for url, _, _ in embed_urls("vit_b32", TEST_URLS, batch_size=1):
+        assert url == TEST_URLS[0]
+        break
+
+
+def test_embed_nothing():
+    assert [] == list(embed_urls("vit_b32", [], batch_size=2))
+
+
+def test_embed_url_uses_the_cache():
+    url = TEST_URLS[0]
+    embedding = embed_url("vit_b32", url)
+    hits = embedding_cache.hits
+    assert pytest.approx(embedding, abs=1e-6) == embed_url("vit_b32", url)
+    assert hits + 1 == embedding_cache.hits
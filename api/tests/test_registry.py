@@ -0,0 +1,28 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from ..registry import Registry
+
+
+def test_registry_creates_values_on_first_access():
+    factory = MagicMock(return_value="value")
+    registry = Registry({"key": factory})
+    factory.assert_not_called()
+
+    assert "value" == registry["key"]
+    assert "value" == registry["key"]
+    factory.assert_called_once_with()
+
+
+def test_registry_unknown_key():
+    with pytest.raises(KeyError):
+        Registry({})["key"]
+
+
+def test_registry_can_be_patched():
+    registry = Registry({"key": lambda: "value"})
+    with patch.dict(registry, {"other": "patched"}):
+        assert "patched" == registry["other"]
+        assert "value" == registry["key"]
+    assert "other" not in registry
+    assert "value" == registry["key"]
@@ -1,8 +1,10 @@
+import asyncio
 import pytest
 from unittest.mock import MagicMock, patch
 import threading
 import time
-from ..rpc_client import RpcClient
+from ..rpc_client import AsyncRpcClient, RpcClient, exception_class, parse_response
+from common import ImageError, ImageSizeTooSmallError
 from ..worker import RpcServer
 from commands import commands
 
@@ -20,6 +22,29 @@ def rpc_server_thread():
     server_thread.join()
 
 
+def test_exception_class():
+    assert ImageSizeTooSmallError == exception_class("ImageSizeTooSmallError")
+    assert ValueError == exception_class("ValueError")
+    # Unknown to the API, or not exceptions
+    assert RuntimeError == exception_class("MilvusException")
+    assert RuntimeError == exception_class("print")
+    assert RuntimeError == exception_class("JOB_QUEUE_NAME")
+
+
+def test_parse_response():
+    assert {"added": []} == parse_response(b'{"added": []}')
+    assert "pong" == parse_response(b'"pong"')
+    with pytest.raises(ImageSizeTooSmallError) as exc_info:
+        parse_response(
+            b'{"exception_type": "ImageSizeTooSmallError", "exception_args": ["small"]}'
+        )
+    assert isinstance(exc_info.value, ImageError)
+    assert "IMAGE_SIZE_TOO_SMALL" == exc_info.value.code
+    assert ("small",) == exc_info.value.args
+    with pytest.raises(RuntimeError):
+        parse_response(b'{"exception_type": "ParamError", "exception_args": ["x"]}')
+
+
 def test_rpc_interaction(rpc_server_thread):
     with patch.dict(commands, {"command": MagicMock(return_value="result")}):
         rpc_client = RpcClient(queue_name=TEST_JOB_QUEUE_NAME)
@@ -31,6 +56,17 @@ def test_rpc_interaction(rpc_server_thread):
         commands["command"].assert_called_once_with("argument")
 
 
+def test_rpc_keyword_arguments(rpc_server_thread):
+    with patch.dict(commands, {"command": MagicMock(return_value="result")}):
+        rpc_client = RpcClient(queue_name=TEST_JOB_QUEUE_NAME)
+
+        rpc_server_thread.start()
+
+        assert "result" == rpc_client("command", ["argument"], {"option": True})
+
+        commands["command"].assert_called_once_with("argument", option=True)
+
+
 def test_parallel_workers(rpc_server_thread):
     blocking_client = RpcClient(queue_name=TEST_JOB_QUEUE_NAME)
     blocking_client_thread = threading.Thread(
@@ -80,3 +116,89 @@ def test_parallel_workers(rpc_server_thread):
         second_rpc_server.connection.close
     )
     second_server_thread.join()
+
+
+def test_concurrent_jobs():
+    rpc_server = RpcServer(queue_name=TEST_JOB_QUEUE_NAME, prefetch=3)
+    server_thread = threading.Thread(target=rpc_server.start)
+
+    # Each job only returns once all of them are running at the same time
+    barrier = threading.Barrier(3, timeout=10)
+
+    def concurrent(i):
+        barrier.wait()
+        return i
+
+    results = {}
+
+    def call(i):
+        results[i] = RpcClient(queue_name=TEST_JOB_QUEUE_NAME)("concurrent", [i])
+
+    with patch.dict(commands, dict(concurrent=concurrent)):
+        client_threads = [threading.Thread(target=call, args=(i,)) for i in range(3)]
+        for client_thread in client_threads:
+            client_thread.start()
+        server_thread.start()
+        for client_thread in client_threads:
+            client_thread.join()
+
+    assert {0: 0, 1: 1, 2: 2} == results
+
+    rpc_server.connection.add_callback_threadsafe(rpc_server.connection.close)
+    server_thread.join()
+
+
+def test_async_client_concurrent_calls():
+    rpc_server = RpcServer(queue_name=TEST_JOB_QUEUE_NAME, prefetch=3)
+    server_thread = threading.Thread(target=rpc_server.start)
+    barrier = threading.Barrier(3, timeout=10)
+
+    def concurrent(i):
+        barrier.wait()
+        return i
+
+    def failing():
+        raise ValueError("invalid")
+
+    async def calls():
+        rpc_client = AsyncRpcClient(queue_name=TEST_JOB_QUEUE_NAME)
+        # All in flight at the same time, on a single connection
+        results = await asyncio.gather(
+            *(rpc_client("concurrent", [i]) for i in range(3))
+        )
+        connection = rpc_client.connection
+        with pytest.raises(ValueError):
+            await rpc_client("failing", [])
+        assert connection is rpc_client.connection
+
+        # Reconnects once the connection is lost
+        connection.close()
+        while not connection.is_closed:
+            await asyncio.sleep(0.01)
+        assert "pong" == await rpc_client("ping", [])
+        assert connection is not rpc_client.connection
+        rpc_client.close()
+        return results
+
+    with patch.dict(commands, dict(concurrent=concurrent, failing=failing)):
+        server_thread.start()
+        assert [0, 1, 2] == asyncio.run(calls())
+
+    rpc_server.connection.add_callback_threadsafe(rpc_server.connection.close)
+    server_thread.join()
+
+
+def test_jobs_in_processes():
+    rpc_server = RpcServer(
+        queue_name=TEST_JOB_QUEUE_NAME, processes=1, process_commands=["ping"]
+    )
+    server_thread = threading.Thread(target=rpc_server.start)
+    server_thread.start()
+
+    # Commands patched in this process are not run by the process pool
+    with patch.dict(commands, {"ping": MagicMock(return_value="patched")}):
+        assert "pong" == RpcClient(queue_name=TEST_JOB_QUEUE_NAME)("ping", [])
+        commands["ping"].assert_not_called()
+
+    rpc_server.connection.add_callback_threadsafe(rpc_server.connection.close)
+    server_thread.join()
@@ -0,0 +1,110 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from .. import writer
+from ..writer import BufferedWriter
+
+
+@pytest.fixture
+def collection():
+    collection = MagicMock()
+    with patch.object(writer, "entity_columns", lambda collection, *columns: columns):
+        with patch.object(writer, "urls_expr", lambda collection, urls: urls):
+            with patch.object(writer, "metadata_values", MagicMock()):
+                yield collection
+
+
+def inserted_chunks(collection):
+    return [call.args[0][0] for call in collection.insert.call_args_list]
+
+
+def test_chunks_by_rows(collection):
+    buffered_writer = BufferedWriter(collection, max_rows=2)
+    for i in range(5):
+        buffered_writer.add(f"url{i}", [0.0] * 4, None)
+    buffered_writer.close()
+
+    assert [["url0", "url1"], ["url2", "url3"], ["url4"]] == inserted_chunks(
+        collection
+    )
+    assert [f"url{i}" for i in range(5)] == buffered_writer.inserted
+    assert [] == buffered_writer.failed
+
+
+def test_chunks_by_bytes(collection):
+    buffered_writer = BufferedWriter(collection, max_bytes=1000)
+    for i in range(3):
+        buffered_writer.add(f"url{i}", [0.0] * 100, {"text": "x" * 300})
+    buffered_writer.close()
+
+    assert [["url0"], ["url1"], ["url2"]] == inserted_chunks(collection)
+
+
+def test_pipeline_depth(collection):
+    buffered_writer = BufferedWriter(collection, max_rows=1, depth=2)
+    for i in range(4):
+        buffered_writer.add(f"url{i}", [0.0], None)
+    # The first chunks were waited for to keep at most 2 in flight
+    assert ["url0"] == buffered_writer.inserted
+    buffered_writer.close()
+    assert 4 == len(buffered_writer.inserted)
+
+
+def test_chunk_failures(collection):
+    failure = MagicMock()
+    failure.result.side_effect = RuntimeError("message too large")
+    collection.insert.side_effect = [MagicMock(), failure, MagicMock()]
+
+    buffered_writer = BufferedWriter(collection, max_rows=1)
+    for i in range(3):
+        buffered_writer.add(f"url{i}", [0.0], None)
+    buffered_writer.close()
+
+    assert ["url0", "url2"] == buffered_writer.inserted
+    assert [
+        {"url": "url1", "error": "message too large", "code": None}
+    ] == buffered_writer.failed
+    assert isinstance(buffered_writer.error, RuntimeError)
+
+
+def test_replace(collection):
+    buffered_writer = BufferedWriter(collection, replace=True, max_rows=2)
+    for i in range(3):
+        buffered_writer.add(f"url{i}", [0.0], None)
+    buffered_writer.close()
+
+    assert [["url0", "url1"], ["url2"]] == [
+        call.args[0] for call in collection.delete.call_args_list
+    ]
+    assert [["url0", "url1"], ["url2"]] == inserted_chunks(collection)
+
+
+def test_replace_keeps_existing_rows_on_invalid_chunk(collection):
+    buffered_writer = BufferedWriter(collection, replace=True)
+    buffered_writer.add("url0", [0.0], None)
+    with patch.object(writer, "entity_columns", side_effect=ValueError("invalid")):
+        buffered_writer.close()
+
+    collection.delete.assert_not_called()
+    collection.insert.assert_not_called()
+    assert [{"url": "url0", "error": "invalid", "code": None}] == buffered_writer.failed
+
+
+def test_invalid_metadata_only_fails_its_row(collection):
+    def metadata_values(collection, metadata):
+        if metadata == "invalid":
+            raise ValueError("Metadata year must be a INT64")
+
+    buffered_writer = BufferedWriter(collection, replace=True)
+    with patch.object(writer, "metadata_values", metadata_values):
+        for i, metadata in enumerate([None, "invalid", None]):
+            buffered_writer.add(f"url{i}", [0.0], metadata)
+    buffered_writer.close()
+
+    assert [["url0", "url2"]] == inserted_chunks(collection)
+    assert [["url0", "url2"]] == [
+        call.args[0] for call in collection.delete.call_args_list
+    ]
+    assert [
+        {"url": "url1", "error": "Metadata year must be a INT64", "code": None}
+    ] == buffered_writer.failed
@@ -0,0 +1,113 @@
+import json
+import os
+from collections import deque
+
+from milvus import entity_columns, metadata_values, urls_expr
+
+# Maximum number of rows and of bytes of a single insert request, to stay well
+# under the size limit of gRPC messages
+INSERT_CHUNK_ROWS = int(os.environ.get("INSERT_CHUNK_ROWS", 1000))
+INSERT_CHUNK_BYTES = int(os.environ.get("INSERT_CHUNK_BYTES", 16 * 2**20))
+# Number of insert requests sent to Milvus without waiting for their result
+INSERT_PIPELINE_DEPTH = int(os.environ.get("INSERT_PIPELINE_DEPTH", 2))
+
+
+def row_size(url, embedding, metadata):
+    # Approximate size of the row in an insert request
+    return len(url) + 4 * len(embedding) + len(json.dumps(metadata)) + 64
+
+
+class BufferedWriter:
+    """
+    Inserts rows in a collection in chunks of at most max_rows rows and
+    max_bytes bytes. Up to depth chunks are sent before waiting for the
+    result of the first one. The urls of the rows of the chunks that failed
+    are reported along with the error in failed, and the first error is kept
+    in error. Chunks are independent, some may be inserted and others not.
+
+    As Milvus does not deduplicate primary keys, existing rows with the same
+    urls are deleted before each chunk is inserted if replace is set.
+    """
+
+    def __init__(
+        self,
+        collection,
+        partition=None,
+        replace=False,
+        max_rows=INSERT_CHUNK_ROWS,
+        max_bytes=INSERT_CHUNK_BYTES,
+        depth=INSERT_PIPELINE_DEPTH,
+    ):
+        self.collection = collection
+        self.partition = partition
+        self.replace = replace
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.depth = depth
+        self.rows = []
+        self.size = 0
+        self.pending = deque()  # (urls, future) of the chunks sent
+        self.inserted = []
+        self.failed = []
+        self.error = None
+
+    def add(self, url, embedding, metadata):
+        try:
+            # Checked for each row, so that an invalid one does not fail the
+            # others of its chunk
+            metadata_values(self.collection, metadata)
+        except ValueError as e:
+            self.fail([url], e)
+            return
+        size = row_size(url, embedding, metadata)
+        if self.rows and (
+            len(self.rows) >= self.max_rows or self.size + size > self.max_bytes
+        ):
+            self.send()
+        self.rows.append((url, embedding, metadata))
+        self.size += size
+
+    def send(self):
+        urls, embeddings, metadatas = (list(column) for column in zip(*self.rows))
+        self.rows = []
+        self.size = 0
+        try:
+            # Built first, so that existing rows are not deleted if it fails
+            columns = entity_columns(self.collection, urls, embeddings, metadatas)
+            if self.replace:
+                # Deleted before the insertion, whose timestamp is later
+                self.collection.delete(urls_expr(self.collection, urls))
+            future = self.collection.insert(
+                columns, partition_name=self.partition, _async=True
+            )
+        except Exception as e:
+            self.fail(urls, e)
+            return
+        self.pending.append((urls, future))
+        while len(self.pending) > self.depth:
+            self.wait()
+
+    def wait(self):
+        urls, future = self.pending.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            self.fail(urls, e)
+            return
+        self.inserted.extend(urls)
+
+    def fail(self, urls, error):
+        print(f"Failed to insert {len(urls)} entities: {error}")
+        self.failed.extend(
+            {"url": url, "error": str(error), "code": getattr(error, "code", None)}
+            for url in urls
+        )
+        if self.error is None:
+            self.error = error
+
+    def close(self):
+        "Sends the last chunk and waits for all of them"
+        if self.rows:
+            self.send()
+        while self.pending:
+            self.wait()